@@ -17,98 +17,132 @@ import sys
 import argparse
 from pathlib import Path
 import re
+import heapq
+import tempfile
+import hashlib
+import os
+import pickle
+import operator
+import itertools
+import json
+import functools
+import struct
+import mmap
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+
+# A file context definition line: path spec, optional file type and context
+FC_LINE = re.compile(r'^(?P<path>\S+)\s+(?P<type>-.)?\s*(?P<context>.+)$')
+
+# A backslash together with the character it escapes
+FC_ESCAPE = re.compile(r'\\.', re.DOTALL)
+
+# Regular expression meta characters which end the stem of a path spec
+FC_META = re.compile(r'[.^$?*+|[({]')
+
+# A bracket expression, where escapes like \- are meaningful, or an escape
+# sequence which is needed (group 1), or a redundant escape of a character
+# without special meaning (group 2)
+FC_NEEDED_ESCAPE = re.compile(r'(\[\^?\]?(?:\\.|[^\]\\])*\]|\\[A-Za-z0-9.^$?*+|\[\](){}\\])|\\(.)',
+                              re.DOTALL)
+
+# Maximum number of compiled path specs kept by compile_path_spec()
+REGEX_CACHE_SIZE = 1 << 14
+
+# Binary file context format: header (magic, version, number of entries,
+# offset of the entries) and fixed size entries (offsets of the path, file
+# type and context strings, meta, stem length and string length)
+FC_BINARY_MAGIC = b'FCSORT\0\0'
+FC_BINARY_VERSION = 1
+FC_BINARY_HEADER = struct.Struct('<8sIQQ')
+FC_BINARY_ENTRY = struct.Struct('<QQQBII')
+FC_BINARY_STRING_LENGTH = struct.Struct('<I')
+
+# Minimum number of lines in a segment cached by SortCache
+SEGMENT_MIN_LINES = 64
+
+# Number of low bits of a packed sort key holding the input position
+SORT_INDEX_BITS = 32
+SORT_INDEX_MASK = (1 << SORT_INDEX_BITS) - 1
+
+# Maximum number of spill files merged at once by external_sort()
+MERGE_FAN_IN = 64
+
+# Approximate memory used by one FileContext besides its path string (the
+# interned context strings are shared between definitions)
+FC_ENTRY_OVERHEAD = 250
 
 
 class FileContext():
     """ Container class for file context defintions
+
+    The instances use __slots__ instead of a per instance __dict__, and the
+    file type and context strings are interned, since the same few hundred
+    contexts are shared by thousands of definitions.
+
+    source is the (input file, line number) tuple of the definition, if
+    it was requested when parsing, and None otherwise.
     """
 
-    def __init__(self, context_line):
+    __slots__ = ('path', 'file_type', 'context', 'meta', 'stem_len', 'str_len', 'sort_key', 'source')
+
+    def __init__(self, context_line, source=None):
         """ Constructor
         """
 
-        matches = re.match(r'^(?P<path>\S+)\s+(?P<type>-.)?\s*(?P<context>.+)$', context_line)
+        matches = FC_LINE.match(context_line)
         if matches is None:
             raise ValueError
 
         self.path, self.file_type, self.context = matches.group('path', 'type', 'context')
 
+        if self.file_type:
+            self.file_type = sys.intern(self.file_type)
+        self.context = sys.intern(self.context)
+        self.source = source
+
         self.compute_diffdata()
 
     def compute_diffdata(self):
         """ Compute the interal values needed for comparing two file context definitions
+
+        An escaped character is not counted at all, but the backslash escaping
+        it counts as one ordinary (non meta) character. Replacing every escape
+        sequence by a single plain character therefore leaves a string where
+        the string length is the length of the string, and the stem length is
+        the position of the first meta character.
         """
 
-        self.meta = False
-        self.stem_len = 0
-        self.str_len = 0
+        path = self.path
+        if '\\' in path:
+            path = FC_ESCAPE.sub('_', path)
 
-        skip_escaped = False
+        self.str_len = len(path)
 
-        for char in self.path:
-            if skip_escaped:
-                skip_escaped = False
-                continue
+        first_meta = FC_META.search(path)
+        if first_meta:
+            self.meta = True
+            self.stem_len = first_meta.start()
+        else:
+            self.meta = False
+            self.stem_len = self.str_len
 
-            if char in ('.', '^', '$', '?', '*', '+', '|', '[', '(', '{',):
-                self.meta = True
-            if char == '\\':
-                skip_escaped = True
+        self.sort_key = (not self.meta, self.stem_len, self.str_len, bool(self.file_type))
 
-            if not self.meta:
-                self.stem_len += 1
+    @staticmethod
+    def get_sort_key(fcd):
+        """ Return the precomputed sort key of a file context definition
 
-            self.str_len += 1
+        The key is the tuple (not meta, stem_len, str_len, has_type), so that
+        less specific definitions sort first: regular expressions before
+        plain paths, then shorter stems, shorter paths and untyped entries.
+        """
 
-    @staticmethod
-    def _compare(a, b):
-        """ Compare two file context definitions
-
-        Returns:
-          -1 if a is less specific than b
-           0 if a and be are equally specific
-           1 if a is more specific than b
-        The comparison is based on the following statements,
-        in order from most important to least important, given a and b:
-           If a is a regular expression and b is not,
-            -> a is less specific than b.
-           If a's stem length is shorter than b's stem length,
-            -> a is less specific than b.
-           If a's string length is shorter than b's string length,
-            -> a is less specific than b.
-           If a does not have a specified type and b does,
-            -> a is less specific than b.
-        """
-
-        # Check to see if either a or b have meta characters and the other doesn't
-        if a.meta and not b.meta:
-            return -1
-        if b.meta and not a.meta:
-            return 1
-
-        # Check to see if either a or b have a shorter stem length than the other
-        if a.stem_len < b.stem_len:
-            return -1
-        if b.stem_len < a.stem_len:
-            return 1
-
-        # Check to see if either a or b have a shorter string length than the other
-        if a.str_len < b.str_len:
-            return -1
-        if b.str_len < a.str_len:
-            return 1
-
-        # Check to see if either a or b has a specified type and the other doesn't
-        if not a.file_type and b.file_type:
-            return -1
-        if not b.file_type and a.file_type:
-            return 1
-
-        # If none of the above conditions were satisfied, then a and b are equally specific
-        return 0
+        return fcd.sort_key
 
     def __lt__(self, other):
-        return self._compare(self, other) == -1
+        return self.sort_key < other.sort_key
 
     def __str__(self):
         if self.file_type:
@@ -117,37 +151,1070 @@ class FileContext():
             return '{}\t\t{}'.format(self.path, self.context)
 
 
+def parse_file_context(infile, lineno, line, with_source=False):
+    """ Parse one line of file context definitions
+
+    Returns a FileContext, or None for comments and empty lines. An
+    unparsable line is reported and exits. With with_source the source
+    of the FileContext is set to (infile, lineno).
+    """
+
+    line = line.strip()
+
+    # Ignore comments and empty lines
+    if not line or line.startswith('#'):
+        return None
+
+    try:
+        return FileContext(line, (str(infile), lineno) if with_source else None)
+    except ValueError:
+        print('{}:{}: unable to parse a file context line: {}'.format(infile, lineno, line))
+        exit(1)
+
+
+def read_file_contexts(infile, with_source=False):
+    """ Parse a file of file context definitions
+
+    Yields one FileContext per definition, in input order.
+    """
+
+    with infile.open('r') as fd:
+        for lineno, line in enumerate(fd, start=1):
+            fcd = parse_file_context(infile, lineno, line, with_source)
+            if fcd:
+                yield fcd
+
+
+def _sort_file(infile, with_source):
+    """ Parse and sort one input file, run in the worker processes of sort_files()
+
+    Returns None if the file could not be parsed.
+    """
+
+    try:
+        file_context_definitions = list(read_file_contexts(infile, with_source))
+    except SystemExit:
+        return None
+
+    file_context_definitions.sort(key=FileContext.get_sort_key)
+
+    return file_context_definitions
+
+
+def sort_files(infiles, jobs=1, with_source=False):
+    """ Parse and sort the file context definitions of several input files
+
+    The files are parsed and sorted separately, in jobs worker processes
+    if jobs is more than 1. The sorted runs are then concatenated in input
+    order and merged by one more (stable) sort, so the result is the same
+    as sorting the concatenation of all input files.
+    """
+
+    if jobs > 1 and len(infiles) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(infiles) // (jobs * 4))
+            runs = list(executor.map(_sort_file, infiles, itertools.repeat(with_source),
+                                     chunksize=chunksize))
+    else:
+        runs = [_sort_file(infile, with_source) for infile in infiles]
+
+    if None in runs:
+        exit(1)
+
+    file_context_definitions = list(itertools.chain.from_iterable(runs))
+    file_context_definitions.sort(key=FileContext.get_sort_key)
+
+    return file_context_definitions
+
+
+def read_segments(infile):
+    """ Split a file of file context definitions into segments
+
+    A segment ends at the first empty line after at least SEGMENT_MIN_LINES
+    lines, so changing some lines changes only the segment containing them
+    (and possibly where it ends). Yields (lineno, text) tuples, where lineno
+    is the line number of the first line of the segment.
+    """
+
+    with infile.open('r') as fd:
+        text = fd.read()
+
+    lineno = 1
+    pos = 0
+
+    while pos < len(text):
+        end = pos
+        for _ in range(SEGMENT_MIN_LINES):
+            end = text.find('\n', end) + 1
+            if not end:
+                break
+
+        # Continue up to the next empty line
+        blank = text.find('\n\n', end) if end else -1
+        end = blank + 2 if blank >= 0 else len(text)
+
+        segment = text[pos:end]
+        yield lineno, segment
+
+        lineno += segment.count('\n')
+        pos = end
+
+
+def get_script_version():
+    """ Return a hash of this script, so caches are not used after it changes
+    """
+
+    with open(os.path.abspath(__file__), 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+class SortCache():
+    """ Persistent cache of parsed file context definitions
+
+    The input is split into segments (see read_segments()), and the cache
+    keeps the packed sort keys, output lines and line numbers (relative to
+    the start of the segment) of every segment, keyed by a hash of its
+    contents. On the next run only segments with new contents are parsed.
+
+    A packed sort key is an integer which orders like FileContext.sort_key,
+    shifted left by SORT_INDEX_BITS. Adding the position of the entry in
+    the input makes every key unique and sorting the keys gives the same
+    stable order as sorting all definitions, but as a sort of plain
+    integers without any Python level work per comparison.
+    """
+
+    VERSION = 2
+
+    def __init__(self, cache_file):
+        """ Constructor, loads the cache file if it is usable
+        """
+
+        self.cache_file = cache_file
+
+        # The packed sort keys depend on the parser and the sort key of
+        # this script, not only on the cache format
+        self.version = (self.VERSION, get_script_version())
+
+        # Segment hash -> (packed sort keys, output lines, line offsets), in
+        # input order
+        self.segments = {}
+
+        try:
+            with cache_file.open('rb') as fd:
+                version, segments = pickle.load(fd)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return
+
+        if version == self.version:
+            self.segments = segments
+
+    def save(self):
+        """ Atomically write the cache file
+        """
+
+        tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        with tmp_file.open('wb') as fd:
+            pickle.dump((self.version, self.segments), fd, pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_file), str(self.cache_file))
+
+    @staticmethod
+    def pack_sort_key(fcd):
+        """ Pack the sort key of a file context definition into an integer
+
+        Path specs are far shorter than 2**20 characters, so the lengths
+        fit in 20 bits each.
+        """
+
+        not_meta, stem_len, str_len, has_type = fcd.sort_key
+
+        return (not_meta << 41 | stem_len << 21 | str_len << 1 | has_type) << SORT_INDEX_BITS
+
+    def sort(self, infiles, with_source=False):
+        """ Sort the file context definitions of the input files, updating the cache
+
+        Returns the sorted output lines, or with with_source the sorted
+        FileContexts with their sources. Only segments which are not in the
+        cache are parsed, and segments no longer in the input are dropped
+        from the cache.
+        """
+
+        segments = {}
+        keys = []
+        lines = []
+        sources = []
+
+        for infile, (start, text) in ((infile, segment) for infile in infiles
+                                      for segment in read_segments(infile)):
+            digest = hashlib.sha1(text.encode()).digest()
+
+            segment = segments.get(digest) or self.segments.get(digest)
+            if segment is None:
+                seg_keys = []
+                seg_lines = []
+                seg_offsets = []
+                for lineno, line in enumerate(text.splitlines(), start=start):
+                    fcd = parse_file_context(infile, lineno, line)
+                    if fcd:
+                        seg_keys.append(self.pack_sort_key(fcd))
+                        seg_lines.append(str(fcd))
+                        seg_offsets.append(lineno - start)
+                segment = (seg_keys, seg_lines, seg_offsets)
+
+            segments[digest] = segment
+
+            seg_keys, seg_lines, seg_offsets = segment
+            keys.extend(map(operator.add, seg_keys, range(len(lines), len(lines) + len(seg_lines))))
+            lines.extend(seg_lines)
+            if with_source:
+                sources.extend((str(infile), start + offset) for offset in seg_offsets)
+
+        self.segments = segments
+
+        keys.sort()
+
+        if with_source:
+            return [FileContext(lines[key & SORT_INDEX_MASK], sources[key & SORT_INDEX_MASK])
+                    for key in keys]
+
+        return [lines[key & SORT_INDEX_MASK] for key in keys]
+
+
+def _write_spill_file(spill_dir, file_context_definitions, source_files):
+    """ Write sorted file context definitions to a new file in spill_dir
+
+    Every line holds the index of the input file in source_files, a dict
+    of input file names to their index, and the line number of the
+    definition (both empty if it has no source), followed by the
+    definition. Returns the path of the file.
+    """
+
+    fd, spill_file = tempfile.mkstemp(dir=spill_dir)
+    with open(fd, 'w') as spill_fd:
+        for fcd in file_context_definitions:
+            if fcd.source:
+                infile, lineno = fcd.source
+                index = source_files.setdefault(infile, len(source_files))
+                print('{}\t{}\t{}'.format(index, lineno, fcd), file=spill_fd)
+            else:
+                print('\t\t{}'.format(fcd), file=spill_fd)
+
+    return spill_file
+
+
+def _read_spill_file(spill_file, source_files):
+    """ Read back the file context definitions of a spill file
+    """
+
+    names = list(source_files)
+
+    with open(spill_file) as spill_fd:
+        for line in spill_fd:
+            index, lineno, line = line.rstrip('\n').split('\t', 2)
+            yield FileContext(line, (names[int(index)], int(lineno)) if index else None)
+
+
+def _merge_spill_files(spill_dir, spill_files, source_files):
+    """ Merge consecutive spill files, at most MERGE_FAN_IN at a time
+
+    Returns the new list of spill files, which has at most MERGE_FAN_IN
+    entries. The files are merged in groups of consecutive runs in their
+    order, so ties keep the order of the input.
+    """
+
+    while len(spill_files) > MERGE_FAN_IN:
+        merged_files = []
+        for start in range(0, len(spill_files), MERGE_FAN_IN):
+            group = spill_files[start:start + MERGE_FAN_IN]
+            if len(group) == 1:
+                merged_files.extend(group)
+                continue
+            merged_files.append(_write_spill_file(spill_dir, heapq.merge(
+                *[_read_spill_file(f, source_files) for f in group], key=FileContext.get_sort_key),
+                source_files))
+            for spill_file in group:
+                os.remove(spill_file)
+        spill_files = merged_files
+
+    return spill_files
+
+
+def external_sort(file_context_definitions, max_memory):
+    """ Sort file context definitions using a bounded amount of memory
+
+    The definitions are collected into chunks of approximately max_memory
+    bytes. Each full chunk is sorted and spilled to a temporary file, and
+    the chunks are then merged, at most MERGE_FAN_IN files at a time so the
+    number of open files stays bounded. Chunks are consecutive runs of the
+    input, they are always merged with their neighbours in order and
+    heapq.merge() prefers earlier inputs on ties, so the result is in the
+    same stable order as a sort of the whole input in memory.
+    """
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spill_files = []
+        source_files = {}
+        chunk = []
+        chunk_size = 0
+
+        for fcd in file_context_definitions:
+            chunk.append(fcd)
+            chunk_size += FC_ENTRY_OVERHEAD + len(fcd.path)
+
+            if chunk_size >= max_memory:
+                chunk.sort(key=FileContext.get_sort_key)
+                spill_files.append(_write_spill_file(spill_dir, chunk, source_files))
+                chunk = []
+                chunk_size = 0
+
+        spill_files = _merge_spill_files(spill_dir, spill_files, source_files)
+
+        # The last chunk is merged straight from memory
+        chunk.sort(key=FileContext.get_sort_key)
+
+        yield from heapq.merge(*[_read_spill_file(f, source_files) for f in spill_files], chunk,
+                               key=FileContext.get_sort_key)
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_path_spec(path_spec):
+    """ Compile a path spec to a regular expression matching whole paths, like setfiles
+
+    The compiled regular expressions are kept in a bounded LRU cache shared
+    by the lookups and the validation. Raises re.error if the path spec is
+    not a valid regular expression.
+    """
+
+    return re.compile('^(?:{})$'.format(path_spec))
+
+
+def _check_path_specs(path_specs):
+    """ Compile path specs, run in the worker processes of PathSpecValidator
+
+    Returns a (path spec, error message) tuple for every invalid path spec.
+    """
+
+    errors = []
+
+    for path_spec in path_specs:
+        try:
+            compile_path_spec(path_spec)
+        except re.error as error:
+            # Positions are relative to the anchored regular expression,
+            # and may point into the added group
+            position = error.pos - len('^(?:') if error.pos is not None else -1
+            if position < 0:
+                errors.append((path_spec, error.msg))
+            else:
+                errors.append((path_spec, '{} at position {}'.format(error.msg, position)))
+
+    return errors
+
+
+class PathSpecValidator():
+    """ Check that the path specs of file context definitions are valid regular expressions
+
+    Every distinct path spec is compiled only once, and with more than one
+    job the distinct path specs are compiled in chunks in worker processes.
+    """
+
+    def __init__(self):
+        """ Constructor
+        """
+
+        # Path spec -> definitions using it
+        self.path_specs = {}
+
+    def add(self, fcd):
+        """ Add a file context definition
+        """
+
+        self.path_specs.setdefault(fcd.path, []).append(fcd)
+
+    def validate(self, jobs=1):
+        """ Print an error for every definition with an invalid path spec
+
+        Returns the number of invalid definitions.
+        """
+
+        path_specs = list(self.path_specs)
+
+        if jobs > 1 and len(path_specs) > 1:
+            chunksize = -(-len(path_specs) // (jobs * 4))
+            chunks = [path_specs[pos:pos + chunksize] for pos in range(0, len(path_specs), chunksize)]
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                errors = list(itertools.chain.from_iterable(executor.map(_check_path_specs, chunks)))
+        else:
+            errors = _check_path_specs(path_specs)
+
+        invalid = 0
+        for path_spec, message in errors:
+            for fcd in self.path_specs[path_spec]:
+                where = '{}:{}'.format(*fcd.source) if fcd.source else 'fc_sort'
+                print('{}: error: invalid path spec {}: {}'.format(where, path_spec, message), file=sys.stderr)
+                invalid += 1
+
+        return invalid
+
+
+def literal_stem(path):
+    """ Return the literal stem of a path spec for looking it up
+
+    Returns a (stem, literal) tuple. Every path matched by the path spec
+    starts with stem, and literal is True if the path spec matches only
+    the stem itself. Unlike stem_len, escape sequences are unescaped here,
+    an escape sequence of a letter or digit (like \\d) ends the stem, a
+    quantifier after the stem makes its last character optional, and a top
+    level alternation makes the stem empty.
+    """
+
+    stem = []
+    pos = 0
+
+    while pos < len(path):
+        char = path[pos]
+        if char == '\\':
+            if pos + 1 < len(path) and not path[pos + 1].isalnum():
+                stem.append(path[pos + 1])
+                pos += 2
+                continue
+            break
+        if FC_META.match(char):
+            break
+        stem.append(char)
+        pos += 1
+
+    if pos == len(path):
+        return ''.join(stem), True
+
+    if path[pos] in '?*{' and stem:
+        stem.pop()
+
+    # Look for a | outside of any group or bracket expression
+    depth = 0
+    while pos < len(path):
+        char = path[pos]
+        if char == '\\':
+            pos += 1
+        elif char == '[':
+            pos += 1
+            if path.startswith('^', pos):
+                pos += 1
+            if path.startswith(']', pos):
+                pos += 1
+            while pos < len(path) and path[pos] != ']':
+                if path[pos] == '\\':
+                    pos += 1
+                pos += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return '', False
+        pos += 1
+
+    return ''.join(stem), False
+
+
+class LookupIndex():
+    """ Index of sorted file context definitions for looking up paths
+
+    Like setfiles, a lookup returns the last definition in the sorted order
+    whose path spec matches the whole path and whose file type, if it has
+    one, is the file type looked up. Instead of trying every regular
+    expression, literal path specs are found in a dictionary, and the other
+    path specs are stored in a trie on the path components of their
+    literal stem, so only the regular expressions whose stem is a prefix
+    of the path are tried.
+    """
+
+    VERSION = 1
+
+    def __init__(self):
+        """ Constructor
+        """
+
+        # (path, file type, context) of every definition, in sorted order
+        self.specs = []
+        # Literal path spec -> indexes of its definitions
+        self.literals = {}
+        # Trie of dicts from path component to child node. The None key
+        # holds (partial component, index) tuples of the definitions whose
+        # stem ends with that partial component at this node.
+        self.trie = {}
+
+    def add(self, fcd):
+        """ Add the next file context definition in sorted order
+        """
+
+        index = len(self.specs)
+        self.specs.append((fcd.path, fcd.file_type, fcd.context))
+
+        stem, literal = literal_stem(fcd.path)
+        if literal:
+            self.literals.setdefault(stem, []).append(index)
+            return
+
+        components = stem.split('/')
+        node = self.trie
+        for component in components[:-1]:
+            node = node.setdefault(component, {})
+        node.setdefault(None, []).append((components[-1], index))
+
+    def save(self, index_file):
+        """ Write the index to a file
+        """
+
+        with index_file.open('wb') as fd:
+            pickle.dump((self.VERSION, self.specs, self.literals, self.trie), fd, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, index_file):
+        """ Read an index written by save()
+        """
+
+        with index_file.open('rb') as fd:
+            version, specs, literals, trie = pickle.load(fd)
+
+        if version != cls.VERSION:
+            raise ValueError('unsupported lookup index version {}'.format(version))
+
+        lookup_index = cls()
+        lookup_index.specs = specs
+        lookup_index.literals = literals
+        lookup_index.trie = trie
+
+        return lookup_index
+
+    @staticmethod
+    def _regex(path_spec):
+        """ Return the compiled regular expression of a path spec, None if it is invalid
+        """
+
+        try:
+            return compile_path_spec(path_spec)
+        except re.error:
+            return None
+
+    def lookup(self, path, file_type=None):
+        """ Return the (path spec, file type, context) applying to path, None if there is none
+
+        file_type is a file type like in the definitions (for example -d),
+        None matches definitions of any file type.
+        """
+
+        literals = self.literals.get(path, [])
+        candidates = list(literals)
+
+        node = self.trie
+        offset = 0
+        for component in path.split('/'):
+            for partial, index in node.get(None, ()):
+                if path.startswith(partial, offset):
+                    candidates.append(index)
+
+            node = node.get(component)
+            if node is None:
+                break
+            offset += len(component) + 1
+
+        for index in sorted(candidates, reverse=True):
+            spec_path, spec_type, context = self.specs[index]
+
+            if file_type and spec_type and file_type != spec_type:
+                continue
+
+            if index in literals:
+                return self.specs[index]
+
+            regex = self._regex(spec_path)
+            if regex and regex.match(path):
+                return self.specs[index]
+
+        return None
+
+
+def normalize_path_spec(path):
+    """ Normalize a path spec by removing redundant escapes, like \\/ or \\-
+
+    Bracket expressions are left as they are. Two path specs with the same
+    normalized path spec match the same paths.
+    """
+
+    if '\\' not in path:
+        return path
+
+    return FC_NEEDED_ESCAPE.sub(r'\1\2', path)
+
+
+class ConflictDetector():
+    """ Find duplicate and shadowed file context definitions
+
+    The definitions are added in sorted order and indexed by their
+    normalized path spec, so equivalent path specs are found by hashing
+    instead of comparing every pair of definitions. Of the definitions with
+    equivalent path specs, setfiles uses the last one in the sorted order
+    which applies to the file type, so an earlier one is unreachable if a
+    later one has the same or no file type. It is reported as a duplicate
+    if the later one has the same path spec and file type, and as
+    shadowed otherwise.
+    """
+
+    def __init__(self):
+        """ Constructor
+        """
+
+        # Normalized path spec -> definitions, in sorted order
+        self.index = {}
+
+    def add(self, fcd):
+        """ Add the next file context definition in sorted order
+        """
+
+        self.index.setdefault(normalize_path_spec(fcd.path), []).append(fcd)
+
+    def conflicts(self):
+        """ Yield a (kind, fcd, winner) tuple for every unreachable definition
+
+        kind is 'duplicate' or 'shadowed', and winner is the definition
+        which is used instead of fcd.
+        """
+
+        for definitions in self.index.values():
+            if len(definitions) < 2:
+                continue
+
+            for pos, fcd in enumerate(definitions[:-1]):
+                for winner in reversed(definitions[pos + 1:]):
+                    if not winner.file_type or winner.file_type == fcd.file_type:
+                        if winner.path == fcd.path and winner.file_type == fcd.file_type:
+                            yield 'duplicate', fcd, winner
+                        else:
+                            yield 'shadowed', fcd, winner
+                        break
+
+    @staticmethod
+    def _describe(fcd):
+        """ Return a dict describing a file context definition for the report
+        """
+
+        return {'path': fcd.path,
+                'file_type': fcd.file_type,
+                'context': fcd.context,
+                'source': '{}:{}'.format(*fcd.source) if fcd.source else None}
+
+    def report(self, report_file=None):
+        """ Print a warning for every conflict, or write them to a JSON report file
+
+        Returns the number of conflicts.
+        """
+
+        conflicts = []
+
+        for kind, fcd, winner in self.conflicts():
+            conflicts.append({'kind': kind,
+                              'conflicting_context': fcd.context != winner.context,
+                              'definition': self._describe(fcd),
+                              'winner': self._describe(winner)})
+
+            if report_file:
+                continue
+
+            where = '{}:{}'.format(*fcd.source) if fcd.source else 'fc_sort'
+            winner_where = ' ({}:{})'.format(*winner.source) if winner.source else ''
+            if kind == 'duplicate':
+                message = 'duplicate file context definition {}'.format(fcd)
+            else:
+                message = 'file context definition {} is shadowed by {}'.format(fcd, winner)
+            if fcd.context != winner.context:
+                message += ', using {}'.format(winner.context)
+            print('{}: warning: {}{}'.format(where, message, winner_where), file=sys.stderr)
+
+        if report_file:
+            with report_file.open('w') as fd:
+                json.dump(conflicts, fd, indent=2)
+                fd.write('\n')
+
+        return len(conflicts)
+
+
+class BinaryFileContextsWriter():
+    """ Writer of the binary format of sorted file context definitions
+
+    The file starts with a header, followed by a string table of length
+    prefixed UTF-8 strings, each distinct string stored once, and then one
+    fixed size entry per definition, in sorted order. An entry holds the
+    offsets of its path, file type (0 if it has none) and context strings
+    and the precomputed meta, stem_len and str_len values. Since the
+    entries have a fixed size, a reader can seek to any of them directly.
+    """
+
+    def __init__(self):
+        """ Constructor
+        """
+
+        self.strings = bytearray(FC_BINARY_HEADER.size)
+        self.string_offsets = {}
+        self.entries = bytearray()
+        self.count = 0
+
+    def _add_string(self, string):
+        """ Add a string to the string table, returning its offset
+        """
+
+        offset = self.string_offsets.get(string)
+        if offset is None:
+            data = string.encode()
+            offset = len(self.strings)
+            self.strings += FC_BINARY_STRING_LENGTH.pack(len(data))
+            self.strings += data
+            self.string_offsets[string] = offset
+
+        return offset
+
+    def add(self, fcd):
+        """ Add the next file context definition in sorted order
+        """
+
+        self.entries += FC_BINARY_ENTRY.pack(self._add_string(fcd.path),
+                                             self._add_string(fcd.file_type) if fcd.file_type else 0,
+                                             self._add_string(fcd.context),
+                                             fcd.meta, fcd.stem_len, fcd.str_len)
+        self.count += 1
+
+    def save(self, binary_file):
+        """ Write the binary file
+        """
+
+        self.strings[:FC_BINARY_HEADER.size] = FC_BINARY_HEADER.pack(
+            FC_BINARY_MAGIC, FC_BINARY_VERSION, self.count, len(self.strings))
+
+        with binary_file.open('wb') as fd:
+            fd.write(self.strings)
+            fd.write(self.entries)
+
+
+BinaryFileContext = namedtuple('BinaryFileContext',
+                               ['path', 'file_type', 'context', 'meta', 'stem_len', 'str_len'])
+
+
+class BinaryFileContexts():
+    """ Reader of the binary format of sorted file context definitions
+
+    The file is memory mapped, and indexing returns a BinaryFileContext
+    whose path, file_type and context are memoryviews of the UTF-8 strings
+    in the mapped file, so nothing is copied (file_type is None if the
+    definition has none). These memoryviews stay valid after close(), the
+    file is then unmapped when the last of them is garbage collected.
+    line() decodes an entry to its line in the text output.
+    """
+
+    def __init__(self, binary_file):
+        """ Constructor, maps the binary file
+        """
+
+        with binary_file.open('rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        try:
+            magic, version, self._count, self._entries_offset = FC_BINARY_HEADER.unpack_from(self._view)
+        except struct.error:
+            magic = version = None
+
+        if magic != FC_BINARY_MAGIC or version != FC_BINARY_VERSION:
+            self.close()
+            raise ValueError('{} is not a binary file context file of version {}'.format(
+                binary_file, FC_BINARY_VERSION))
+
+    def close(self):
+        """ Unmap the binary file, or leave that to the garbage collector
+        while memoryviews of entries still use it
+        """
+
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _string(self, offset):
+        """ Return a memoryview of the string at offset in the string table
+        """
+
+        length, = FC_BINARY_STRING_LENGTH.unpack_from(self._view, offset)
+        offset += FC_BINARY_STRING_LENGTH.size
+
+        return self._view[offset:offset + length]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('binary file context index out of range')
+
+        path, file_type, context, meta, stem_len, str_len = FC_BINARY_ENTRY.unpack_from(
+            self._view, self._entries_offset + index * FC_BINARY_ENTRY.size)
+
+        return BinaryFileContext(self._string(path), self._string(file_type) if file_type else None,
+                                 self._string(context), bool(meta), stem_len, str_len)
+
+    def line(self, index):
+        """ Return the line of the text output of an entry
+        """
+
+        entry = self[index]
+        path = str(entry.path, 'utf-8')
+        context = str(entry.context, 'utf-8')
+
+        if entry.file_type is not None:
+            return '{}\t\t{}\t{}'.format(path, str(entry.file_type, 'utf-8'), context)
+        else:
+            return '{}\t\t{}'.format(path, context)
+
+
+def verify_binary(binary_file, file_context_definitions):
+    """ Check that a binary file reads back as the given sorted definitions
+
+    Prints an error for the first entry which differs and returns whether
+    the whole file matches.
+    """
+
+    with BinaryFileContexts(binary_file) as binary:
+        if len(binary) != len(file_context_definitions):
+            print('{}: error: {} entries instead of {}'.format(
+                binary_file, len(binary), len(file_context_definitions)), file=sys.stderr)
+            return False
+
+        for index, fcd in enumerate(file_context_definitions):
+            entry = binary[index]
+            if binary.line(index) != str(fcd) or \
+                    (entry.meta, entry.stem_len, entry.str_len) != (fcd.meta, fcd.stem_len, fcd.str_len):
+                print('{}: error: entry {} does not match {}'.format(binary_file, index, fcd),
+                      file=sys.stderr)
+                return False
+
+    return True
+
+
+def memory_size(value):
+    """ Convert a memory size like 64M, with an optional K, M or G suffix, to bytes
+    """
+
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+    multiplier = units.get(value[-1:].upper(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+
+    try:
+        size = int(value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid memory size: {}'.format(value))
+
+    if size <= 0:
+        raise argparse.ArgumentTypeError('memory size must be positive')
+
+    return size
+
+
+def run_lookups(lookup_index, paths, file_type):
+    """ Print the context applying to every path
+
+    A path of - reads paths from stdin, one per line, each optionally
+    followed by a file type. Returns False if any path has no context.
+    """
+
+    found = True
+
+    for path in paths:
+        if path == '-':
+            requests = (line.split() for line in sys.stdin)
+        else:
+            requests = [[path]]
+
+        for request in requests:
+            if not request:
+                continue
+
+            spec = lookup_index.lookup(request[0], request[1] if len(request) > 1 else file_type)
+            if spec:
+                print('{}\t{}'.format(request[0], spec[2]))
+            else:
+                print('{}: no matching file context'.format(request[0]), file=sys.stderr)
+                found = False
+
+    return found
+
+
+def write_provenance(provenance_file, file_context_definitions):
+    """ Write the source of every sorted file context definition
+
+    Line N of the provenance file is the module name, the input file and
+    the line number in it of line N of the sorted output.
+    """
+
+    with provenance_file.open('w') as fd:
+        for fcd in file_context_definitions:
+            infile, lineno = fcd.source
+            module = os.path.splitext(os.path.basename(infile))[0]
+            print('{}\t{}:{}'.format(module, infile, lineno), file=fd)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Sort file context definitions')
-    parser.add_argument('infile', metavar='INFILE', type=Path,
-                        help='input file of the original file context definitions')
-    parser.add_argument('outfile', metavar='OUTFILE', nargs='?', type=Path, default=None,
+    parser.add_argument('infiles', metavar='INFILE', nargs='*', type=Path,
+                        help='input files of the original file context definitions, '
+                             'without -o the second file is the output file instead')
+    parser.add_argument('-o', '--output', metavar='OUTFILE', type=Path, default=None,
                         help='output file for the sorted file context definitions')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='parse and sort the input files in N worker processes')
+    parser.add_argument('--provenance', metavar='FILE', type=Path, default=None,
+                        help='write the module, input file and line number of every output line to FILE')
+    parser.add_argument('--check', action='store_true',
+                        help='warn about duplicate and shadowed file context definitions')
+    parser.add_argument('--report', metavar='REPORTFILE', type=Path, default=None,
+                        help='write the duplicate and shadowed file context definitions to a JSON file')
+    parser.add_argument('--validate', action='store_true',
+                        help='check that every path spec is a valid regular expression')
+    parser.add_argument('--binary', metavar='BINFILE', type=Path, default=None,
+                        help='also write the sorted file context definitions in binary format to BINFILE')
+    parser.add_argument('--verify-binary', action='store_true',
+                        help='read BINFILE back after writing it and check it against the sorted definitions')
+    parser.add_argument('--max-memory', metavar='SIZE', type=memory_size, default=None,
+                        help='sort in chunks of about SIZE bytes (K, M and G suffixes are allowed) '
+                             'spilled to temporary files, instead of sorting everything in memory')
+    parser.add_argument('--cache', metavar='CACHEFILE', type=Path, default=None,
+                        help='cache file of a previous run, only changed parts of the input are parsed again')
+    parser.add_argument('--write-index', metavar='INDEXFILE', type=Path, default=None,
+                        help='write a lookup index of the sorted file context definitions')
+    parser.add_argument('--index', metavar='INDEXFILE', type=Path, default=None,
+                        help='use a lookup index written by --write-index instead of an input file')
+    parser.add_argument('--lookup', metavar='PATH', nargs='+', default=None,
+                        help='print the context which applies to every PATH, '
+                             '- reads paths (each optionally followed by a file type) from stdin')
+    parser.add_argument('--file-type', metavar='TYPE', default=None,
+                        help='file type of the PATHs looked up, like --file-type=-d')
     args = parser.parse_args()
 
-    file_context_definitions = []
+    # Without -o the arguments are INFILE [OUTFILE]
+    if args.output:
+        infiles, outfile = args.infiles, args.output
+    elif len(args.infiles) > 2:
+        parser.error('use -o OUTFILE with more than one input file')
+    else:
+        infiles, outfile = args.infiles[:1], (args.infiles[1:] or [None])[0]
 
-    # Parse the input file
-    with args.infile.open('r') as fd:
-        for lineno, line in enumerate(fd, start=1):
-            line = line.strip()
+    if args.cache and args.max_memory:
+        parser.error('--cache and --max-memory can not be used together')
+    if args.provenance and (args.cache or args.max_memory):
+        parser.error('--provenance can not be used with --cache or --max-memory')
+    if args.index and (infiles or args.write_index):
+        parser.error('--index can not be used with an input file or --write-index')
+    if not args.index and not infiles:
+        parser.error('an input file is required')
+    if args.index and not args.lookup:
+        parser.error('--index is only used with --lookup')
+    if args.jobs < 1:
+        parser.error('the number of jobs must be positive')
+    if args.verify_binary and not args.binary:
+        parser.error('--verify-binary is only used with --binary')
 
-            # Ignore comments and empty lines
-            if not line or line.startswith('#'):
-                continue
+    if args.index:
+        lookup_index = LookupIndex.load(args.index)
+    else:
+        lookup_index = LookupIndex() if args.write_index or args.lookup else None
+        conflict_detector = ConflictDetector() if args.check or args.report else None
+        validator = PathSpecValidator() if args.validate else None
+        binary_writer = BinaryFileContextsWriter() if args.binary else None
+        binary_definitions = [] if args.verify_binary else None
 
-            try:
-                file_context_definitions.append(FileContext(line))
-            except ValueError:
-                print('{}:{}: unable to parse a file context line: {}'.format(args.infile, lineno, line))
-                exit(1)
+        # Parse the input files and sort
+        if args.cache:
+            sort_cache = SortCache(args.cache)
+            if lookup_index or conflict_detector or validator or binary_writer:
+                file_context_definitions = sort_cache.sort(infiles, with_source=True)
+            else:
+                file_context_definitions = sort_cache.sort(infiles)
+            sort_cache.save()
+        elif args.max_memory:
+            with_source = bool(conflict_detector or validator)
+            file_context_definitions = external_sort(
+                itertools.chain.from_iterable(read_file_contexts(infile, with_source) for infile in infiles),
+                args.max_memory)
+        else:
+            file_context_definitions = sort_files(infiles, args.jobs,
+                                                  bool(args.provenance or conflict_detector or validator))
 
-    # Sort
-    file_context_definitions.sort()
+        # Print output, either to file or if no output file given to stdout,
+        # unless stdout is used for the lookups. The output file is written
+        # under a temporary name and only renamed once it is validated, so
+        # make never sees a failed output as up to date.
 
-    # Print output, either to file or if no output file given to stdout
+        tmp_outfile = outfile.with_name(outfile.name + '.tmp') if outfile else None
 
-    with args.outfile.open('w') if args.outfile else sys.stdout as fd:
-        for fcd in file_context_definitions:
-            print(fcd, file=fd)
+        write_output = outfile or not args.lookup
+        fd = tmp_outfile.open('w') if outfile else sys.stdout
+
+        try:
+            for fcd in file_context_definitions:
+                if write_output:
+                    print(fcd, file=fd)
+                if lookup_index:
+                    lookup_index.add(fcd)
+                if conflict_detector:
+                    conflict_detector.add(fcd)
+                if validator:
+                    validator.add(fcd)
+                if binary_writer:
+                    binary_writer.add(fcd)
+                if binary_definitions is not None:
+                    binary_definitions.append(fcd)
+        finally:
+            if outfile:
+                fd.close()
+
+        if conflict_detector:
+            conflict_detector.report(args.report)
+
+        # The binary file is written under a temporary name too, and both
+        # outputs are only renamed once they are validated and verified
+        failed = validator and validator.validate(args.jobs)
+
+        if binary_writer and not failed:
+            tmp_binary = args.binary.with_name(args.binary.name + '.tmp')
+            binary_writer.save(tmp_binary)
+            if binary_definitions is not None and not verify_binary(tmp_binary, binary_definitions):
+                failed = True
+            if failed:
+                os.remove(str(tmp_binary))
+
+        if failed:
+            if outfile:
+                os.remove(str(tmp_outfile))
+            exit(1)
+
+        if outfile:
+            os.replace(str(tmp_outfile), str(outfile))
+        if binary_writer:
+            os.replace(str(tmp_binary), str(args.binary))
+
+        if args.provenance:
+            write_provenance(args.provenance, file_context_definitions)
+
+        if args.write_index:
+            lookup_index.save(args.write_index)
+
+    if args.lookup and not run_lookups(lookup_index, args.lookup, args.file_type):
+        exit(1)
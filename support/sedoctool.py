@@ -18,7 +18,13 @@ import getopt
 import pyplate
 import os
 import string
-from xml.dom.minidom import parse, parseString
+import collections
+import hashlib
+import pickle
+import functools
+import multiprocessing
+import concurrent.futures
+from xml.etree.ElementTree import XMLParser, TreeBuilder, Comment
 
 #modules enabled and disabled values
 MOD_BASE = "base"
@@ -33,82 +39,228 @@ BOOL_DISABLED = "false"
 TUN_ENABLED = "true"
 TUN_DISABLED = "false"
 
+#records read from the policy XML by read_policy_xml(). Summaries and
+#descriptions are kept formatted as HTML, and as text where the
+#configuration files need them. Global bools and tunables have no layer
+#and module.
+Module = collections.namedtuple("Module",
+	"layer name summary summary_txt desc required")
+Interface = collections.namedtuple("Interface",
+	"kind layer module name summary desc params")
+Param = collections.namedtuple("Param", "name desc optional unused")
+Boolean = collections.namedtuple("Boolean",
+	"kind layer module name dftval desc desc_txt")
+Summary = collections.namedtuple("Summary", "parent desc")
+
+#file in the docs directory with the render input hashes of the pages
+DOC_MANIFEST = ".sedoctool.manifest"
+
+#indexes of the records used by gen_docs(), built by index_records()
+DocIndex = collections.namedtuple("DocIndex",
+	"modules interfaces templates booleans tunables global_booleans "
+	"global_tunables summaries")
+
+
+class PolicyXMLReader(TreeBuilder):
+	"""
+	Parser target which builds the tree of the policy XML like a
+	TreeBuilder, and the records of read_policy_xml() as elements end.
+	Comments are kept as Comment elements, they are part of the formatted
+	descriptions; TreeBuilder only does this itself since Python 3.8.
+	"""
+
+	def __init__(self):
+		TreeBuilder.__init__(self)
+		self.records = []
+		self.parents = []
+		self.summaries = {}
+		self.params = []
+		self.layer = self.module = None
+
+	def comment(self, data):
+		TreeBuilder.start(self, Comment, {})
+		TreeBuilder.data(self, data)
+		TreeBuilder.end(self, Comment)
+
+	def start(self, tag, attrs):
+		node = TreeBuilder.start(self, tag, attrs)
+		self.parents.append(node)
+		if node.tag == "layer":
+			self.layer = node.get("name", "")
+		elif node.tag == "module":
+			self.module = node.get("name", "")
+		elif node.tag in ("interface", "template"):
+			self.params = []
+		return node
+
+	def end(self, tag):
+		node = TreeBuilder.end(self, tag)
+		self.parents.pop()
+		records = self.records
+		summaries = self.summaries
+
+		if node.tag == "summary":
+			# Remember the last summary of each element.
+			parent = self.parents[-1]
+			desc = format_html_desc(node)
+			summaries[parent] = (node, desc)
+			if "name" in parent.attrib:
+				records.append(Summary(parent.get("name"), desc))
+
+		elif node.tag == "param":
+			summary = summaries.pop(node, (None, None))[1]
+			self.params.append(Param(node.get("name", ""), summary,
+				node.get("optional") == "true",
+				node.get("unused") == "true"))
+
+		elif node.tag in ("interface", "template"):
+			summary = summaries.pop(node, (None, None))[1]
+			desc = last_child(node, "desc")
+			if desc is not None:
+				desc = format_html_desc(desc)
+			records.append(Interface(node.tag, self.layer, self.module,
+				node.get("name", ""), summary, desc, tuple(self.params)))
+			node.clear()
+
+		elif node.tag in ("bool", "tunable"):
+			desc = last_child(node, "desc")
+			if desc is not None:
+				desc_txt = format_txt_desc(desc)
+				desc = format_html_desc(desc)
+			else:
+				desc_txt = None
+			if self.parents[-1].tag == "policy":
+				records.append(Boolean(node.tag, None, None,
+					node.get("name", ""), node.get("dftval", ""), desc, desc_txt))
+			else:
+				records.append(Boolean(node.tag, self.layer, self.module,
+					node.get("name", ""), node.get("dftval", ""), desc, desc_txt))
+			node.clear()
+
+		elif node.tag == "module":
+			summary = summary_txt = None
+			if node in summaries:
+				summary_node, summary = summaries.pop(node)
+				summary_txt = format_txt_desc(summary_node)
+			desc = last_child(node, "desc")
+			if desc is not None:
+				desc = format_html_desc(desc)
+			else:
+				desc = ''
+			required = False
+			for req in node.iter("required"):
+				if req.get("val") == "true":
+					required = True
+			records.append(Module(self.layer, self.module, summary,
+				summary_txt, desc, required))
+			node.clear()
+			self.module = None
+
+		elif node.tag == "layer":
+			summaries.pop(node, None)
+			node.clear()
+			self.layer = None
+
+		return node
 
 def read_policy_xml(filename):
 	"""
-	Takes in XML from a file and returns a parsed file.
+	Reads the policy XML from a file and returns a list of records for its
+	summaries, interfaces, templates, bools, tunables and modules, in the
+	order their elements end. The XML is parsed incrementally, and elements
+	are cleared as soon as their records are built.
 	"""
 
 	try:
-		xml_fh = open(filename)
+		xml_fh = open(filename, "rb")
 	except:
 		error("error opening " + filename)
 
+	reader = PolicyXMLReader()
+	parser = XMLParser(target=reader)
+
 	try:
-		doc = parseString(xml_fh.read())
-	except: 
+		while True:
+			data = xml_fh.read(65536)
+			if not data:
+				break
+			parser.feed(data)
+		parser.close()
+	except:
 		xml_fh.close()
 		error("Error while parsing xml")
 
-	xml_fh.close()	
-	return doc
+	xml_fh.close()
+	return reader.records
 
-def gen_booleans_conf(doc, file_name, namevalue_list):
+def last_child(node, tag):
 	"""
-	Generates the booleans configuration file using the XML provided and the
-	previous booleans configuration.
+	Returns the last child element of a node with the tag, or None.
 	"""
 
-	for node in doc.getElementsByTagName("bool"):
-		for desc in node.getElementsByTagName("desc"):
-			bool_desc = format_txt_desc(desc)
-		s = bool_desc.split("\n")
-		file_name.write("#\n")
-		for line in s:
-			file_name.write("# %s\n" % line)
+	found = None
+	for child in node:
+		if child.tag == tag:
+			found = child
+	return found
 
-		bool_name = bool_val = None
-		for (name, value) in node.attributes.items():
-			if name == "name":
-				bool_name = value
-			elif name == "dftval":
-				bool_val = value
+def index_records(records):
+	"""
+	Indexes the records read by read_policy_xml() in a single pass. The
+	modules are indexed by layer, the interfaces, templates, bools and
+	tunables by (layer, module), and the last summary of each element by
+	the name of the element. Global bools and tunables are kept apart.
+	"""
 
-			if [bool_name,BOOL_ENABLED] in namevalue_list:
-				bool_val = BOOL_ENABLED
-			elif [bool_name,BOOL_DISABLED] in namevalue_list:
-				bool_val = BOOL_DISABLED
+	index = DocIndex(collections.OrderedDict(), {}, {}, {}, {}, [], [], {})
+	by_kind = { "interface" : index.interfaces,
+		    "template" : index.templates,
+		    "bool" : index.booleans,
+		    "tunable" : index.tunables }
+	global_kind = { "bool" : index.global_booleans,
+			"tunable" : index.global_tunables }
+
+	for record in records:
+		if isinstance(record, Module):
+			index.modules.setdefault(record.layer, []).append(record)
+		elif isinstance(record, Summary):
+			index.summaries[record.parent] = record.desc
+		elif record.layer is None:
+			global_kind[record.kind].append(record)
+		else:
+			key = (record.layer, record.module)
+			by_kind[record.kind].setdefault(key, []).append(record)
 
-			if bool_name and bool_val:
-				file_name.write("%s = %s\n\n" % (bool_name, bool_val))
-				bool_name = bool_val = None
+	return index
+
+def gen_booleans_conf(records, file_name, namevalues):
+	"""
+	Generates the booleans configuration file using the XML provided and the
+	previous booleans configuration.
+	"""
 
 	# tunables are currently implemented as booleans
-	for node in doc.getElementsByTagName("tunable"):
-		for desc in node.getElementsByTagName("desc"):
-			bool_desc = format_txt_desc(desc)
-		s = bool_desc.split("\n")
-		file_name.write("#\n")
-		for line in s:
-			file_name.write("# %s\n" % line)
-
-		bool_name = bool_val = None
-		for (name, value) in node.attributes.items():
-			if name == "name":
-				bool_name = value
-			elif name == "dftval":
-				bool_val = value
-
-			if [bool_name,BOOL_ENABLED] in namevalue_list:
-				bool_val = BOOL_ENABLED
-			elif [bool_name,BOOL_DISABLED] in namevalue_list:
-				bool_val = BOOL_DISABLED
+	for kind in ("bool", "tunable"):
+		for record in records:
+			if not isinstance(record, Boolean) or record.kind != kind:
+				continue
+
+			if record.desc_txt is not None:
+				bool_desc = record.desc_txt
+			s = bool_desc.split("\n")
+			file_name.write("#\n")
+			for line in s:
+				file_name.write("# %s\n" % line)
+
+			bool_name = record.name
+			bool_val = record.dftval
+			if namevalues.get(bool_name) in (BOOL_ENABLED, BOOL_DISABLED):
+				bool_val = namevalues[bool_name]
 
 			if bool_name and bool_val:
 				file_name.write("%s = %s\n\n" % (bool_name, bool_val))
-				bool_name = bool_val = None
 
-def gen_module_conf(doc, file_name, namevalue_list):
+def gen_module_conf(records, file_name, namevalues):
 	"""
 	Generates the module configuration file using the XML provided and the
 	previous module configuration.
@@ -128,21 +280,17 @@ def gen_module_conf(doc, file_name, namevalue_list):
 	# For required in [True,False] is present so that the requiered modules
 	# are at the top of the config file.
 	for required in [True,False]:
-		for node in doc.getElementsByTagName("module"):
-			mod_req = False
-			for req in node.getElementsByTagName("required"):
-				if req.getAttribute("val") == "true":
-					mod_req = True
+		for record in records:
+			if not isinstance(record, Module):
+				continue
+			mod_req = record.required
 
 			# Skip if we arnt working on the right set of modules.
 			if mod_req and not required or not mod_req and required:
 				continue
 
-
-			mod_name = mod_layer = None
-
-			mod_name = node.getAttribute("name")	
-			mod_layer = node.parentNode.getAttribute("name")
+			mod_name = record.name
+			mod_layer = record.layer
 
 			if mod_name and mod_layer:
 				file_name.write("# Layer: %s\n# Module: %s\n" % (mod_layer,mod_name))
@@ -150,21 +298,20 @@ def gen_module_conf(doc, file_name, namevalue_list):
 					file_name.write("# Required in base\n")
 				file_name.write("#\n")
 
-			for desc in node.getElementsByTagName("summary"):
-				if not desc.parentNode == node:
-					continue
-				s = format_txt_desc(desc).split("\n")
+			if record.summary_txt is not None:
+				s = record.summary_txt.split("\n")
 				for line in s:
 					file_name.write("# %s\n" % line)
 
+				mod_val = namevalues.get(mod_name)
 				# If the module is set as disabled.
-				if [mod_name, MOD_DISABLED] in namevalue_list:
+				if mod_val == MOD_DISABLED:
 					file_name.write("%s = %s\n\n" % (mod_name, MOD_DISABLED))
 				# If the module is set as enabled.
-				elif [mod_name, MOD_ENABLED] in namevalue_list:
+				elif mod_val == MOD_ENABLED:
 					file_name.write("%s = %s\n\n" % (mod_name, MOD_ENABLED))
 				# If the module is set as base.
-				elif [mod_name, MOD_BASE] in namevalue_list:
+				elif mod_val == MOD_BASE:
 					file_name.write("%s = %s\n\n" % (mod_name, MOD_BASE))
 				# If the module is a new module.
 				else:
@@ -177,13 +324,14 @@ def gen_module_conf(doc, file_name, namevalue_list):
 
 def get_conf(conf):
 	"""
-	Returns a list of [name, value] pairs from a config file with the format
+	Returns a dictionary of name to value from a config file with the format
 	name = value
+	If a name is set more than once, the last value is kept.
 	"""
 
 	conf_lines = conf.readlines()
 
-	namevalue_list = []
+	namevalues = {}
 	for i in range(0,len(conf_lines)):
 		line = conf_lines[i]
 		if line.strip() != '' and line.strip()[0] != "#":
@@ -205,9 +353,9 @@ def get_conf(conf):
 					 % (i, line.strip()))
 				continue
 
-			namevalue_list.append(namevalue)
+			namevalues[namevalue[0]] = namevalue[1]
 
-	return namevalue_list
+	return namevalues
 
 def first_cmp_func(a):
 	"""
@@ -264,23 +412,45 @@ def gen_doc_menu(mod_layer, module_list):
 		x[1].sort(key=first_cmp_func)
 	return menu
 
+def node_name(node):
+	"""
+	Returns the name of a XML node, as in the DOM.
+	"""
+
+	if node.tag is Comment:
+		return "#comment"
+	return node.tag
+
+def first_data(node):
+	"""
+	Returns the data of the first child of a XML node, its text or a
+	comment.
+	"""
+
+	if node.text or len(node) == 0 or node[0].tag is not Comment:
+		return node.text
+	return node[0].text
+
 def format_html_desc(node):
 	"""
 	Formats a XML node into a HTML format.
 	"""
 
 	desc_buf = ''
-	for desc in node.childNodes:
-		if desc.nodeName == "#text":
-			if desc.data is not '':
-				if desc.parentNode.nodeName != "p":
-					desc_buf += "<p>" + desc.data + "</p>"
-				else:
-					desc_buf += desc.data
+	if node.text and node.tag is not Comment:
+		if node.tag != "p":
+			desc_buf += "<p>" + node.text + "</p>"
 		else:
-			desc_buf += "<" + desc.nodeName + ">" \
-				 + format_html_desc(desc) \
-				 + "</" + desc.nodeName +">"
+			desc_buf += node.text
+	for desc in node:
+		desc_buf += "<" + node_name(desc) + ">" \
+			 + format_html_desc(desc) \
+			 + "</" + node_name(desc) +">"
+		if desc.tail:
+			if node.tag != "p":
+				desc_buf += "<p>" + desc.tail + "</p>"
+			else:
+				desc_buf += desc.tail
 
 	return desc_buf
 
@@ -290,22 +460,173 @@ def format_txt_desc(node):
 	"""
 
 	desc_buf = ''
-	for desc in node.childNodes:
-		if desc.nodeName == "#text":
-			desc_buf += desc.data + "\n"
-		elif desc.nodeName == "p":
-			desc_buf += desc.firstChild.data + "\n"
-			for chld in desc.childNodes: 
-				if chld.nodeName == "ul":
+	if node.text:
+		desc_buf += node.text + "\n"
+	for desc in node:
+		if desc.tag == "p":
+			desc_buf += first_data(desc) + "\n"
+			for chld in desc: 
+				if chld.tag == "ul":
 					desc_buf += "\n"
-					for li in chld.getElementsByTagName("li"):
-						desc_buf += "\t -" + li.firstChild.data + "\n"
+					for li in chld.iter("li"):
+						desc_buf += "\t -" + first_data(li) + "\n"
+		if desc.tail:
+			desc_buf += desc.tail + "\n"
 
 	return desc_buf.strip() + "\n"
 
-def gen_docs(doc, working_dir, templatedir):
+def get_doc_version(template_data):
+	"""
+	Returns a hash of this script, pyplate and the template data, which
+	every page depends on.
+	"""
+
+	version = hashlib.sha1()
+	for file_name in (__file__, pyplate.__file__):
+		script_file = open(os.path.abspath(file_name), "rb")
+		version.update(script_file.read())
+		script_file.close()
+	for data in template_data:
+		version.update(data.encode("utf-8"))
+
+	return version.hexdigest()
+
+def read_doc_manifest(manifest_file):
+	"""
+	Returns the manifest written by write_doc_manifest(), or an empty one
+	if it cannot be read.
+	"""
+
+	try:
+		manifest = open(manifest_file, "rb")
+		result = pickle.load(manifest)
+		manifest.close()
+	except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+		return {}
+
+	return result
+
+def write_doc_manifest(manifest_file, page_hashes):
+	"""
+	Writes the manifest of the pages: the hash of the render inputs of each
+	page along with the size and modification time of its file.
+	"""
+
+	manifest = {}
+	for file_name, page_hash in page_hashes.items():
+		page_stat = os.stat(file_name)
+		manifest[file_name] = (page_hash, page_stat.st_size,
+			page_stat.st_mtime_ns)
+
+	try:
+		manifest_fh = open(manifest_file + ".tmp", "wb")
+		pickle.dump(manifest, manifest_fh, pickle.HIGHEST_PROTOCOL)
+		manifest_fh.close()
+		os.replace(manifest_file + ".tmp", manifest_file)
+	except (IOError, OSError):
+		warning("Could not write " + manifest_file)
+
+def page_outdated(file_name, inputs, manifest, page_hashes):
+	"""
+	Records the hash of the render inputs of a page in page_hashes, and
+	returns whether the page has to be rendered: its inputs changed since
+	the manifest was written, or its file was changed or removed.
+	"""
+
+	page_hash = hashlib.sha1(repr(inputs).encode("utf-8")).hexdigest()
+	page_hashes[file_name] = page_hash
+
+	if file_name not in manifest:
+		return True
+	old_hash, old_size, old_mtime = manifest[file_name]
+	try:
+		page_stat = os.stat(file_name)
+	except OSError:
+		return True
+
+	return old_hash != page_hash or page_stat.st_size != old_size \
+		or page_stat.st_mtime_ns != old_mtime
+
+def get_pool(jobs):
+	"""
+	Returns a pool of jobs worker processes.
+	"""
+
+	# Forked workers inherit the templates and the working directory.
+	# Before Python 3.7 the context cannot be chosen, the default is fork
+	# on Unix.
+	if sys.version_info < (3, 7):
+		return concurrent.futures.ProcessPoolExecutor(jobs)
+	return concurrent.futures.ProcessPoolExecutor(jobs,
+		mp_context=multiprocessing.get_context("fork"))
+
+def write_module_page(page_templates, page):
+	"""
+	Renders the HTML page of a module, described by gen_docs(), with the
+	given template data and writes it in the current directory.
+	"""
+
+	interface_tpl = pyplate.Template(page_templates["interface"])
+	interface_buf = interface_tpl.execute_string({"interfaces" : page["interfaces"]})
+
+	template_tpl = pyplate.Template(page_templates["template"])
+	template_buf = template_tpl.execute_string({"templates" : page["templates"]})
+
+	boolean_tpl = pyplate.Template(page_templates["boolean"])
+	boolean_buf = boolean_tpl.execute_string({"booleans" : page["booleans"]})
+
+	tunable_tpl = pyplate.Template(page_templates["tunable"])
+	tunable_buf = tunable_tpl.execute_string({"tunables" : page["tunables"]})
+
+	menu_tpl = pyplate.Template(page_templates["menu"])
+	menu_buf = menu_tpl.execute_string({ "menulist" : page["menu"] })
+
+	# pyplate's execute_string gives us a line of whitespace in
+	# template_buf or interface_buf if there are no interfaces or
+	# templates for this module. This is problematic because the
+	# HTML templates use a conditional if on interface_buf or
+	# template_buf being 'None' to decide if the "Template:" or
+	# "Interface:" headers need to be printed in the module pages.
+	# This detects if either of these are just whitespace, and sets
+	# their values to 'None' so that when applying it to the
+	# templates, they are properly recognized as not existing.
+	if not interface_buf.strip():
+		interface_buf = None
+	if not template_buf.strip():
+		template_buf = None
+	if not tunable_buf.strip():
+		tunable_buf = None
+	if not boolean_buf.strip():
+		boolean_buf = None
+
+	module_args = { "mod_layer" : page["mod_layer"],
+		      "mod_name" : page["mod_name"],
+		      "mod_summary" : page["mod_summary"],
+		      "mod_desc" : page["mod_desc"],
+		      "mod_req" : page["mod_req"],
+		      "interfaces" : interface_buf,
+		      "templates" : template_buf,
+		      "tunables" : tunable_buf,
+		      "booleans" : boolean_buf }
+
+	module_tpl = pyplate.Template(page_templates["module"])
+	module_buf = module_tpl.execute_string(module_args)
+
+	body_args = { "menu" : menu_buf,
+		      "content" : module_buf }
+		  
+	module_file = page["mod_layer"] + "_" + page["mod_name"] + ".html"
+	module_fh = open(module_file, "w")
+	body_tpl = pyplate.Template(page_templates["body"])
+	body_tpl.execute(module_fh, body_args)
+	module_fh.close()
+
+def gen_docs(records, working_dir, templatedir, jobs=1):
 	"""
-	Generates all the documentation.
+	Generates all the documentation. The module pages are rendered in jobs
+	worker processes. Pages whose render inputs did not change since the
+	last run, according to the manifest in the working directory, are not
+	rendered again.
 	"""
 
 	try:
@@ -356,398 +677,368 @@ def gen_docs(doc, working_dir, templatedir):
 		error("Could not open templates")
 
 
+	# before the chdir, the script paths may be relative
+	doc_version = get_doc_version((bodydata, intdata, templatedata,
+		tundata, booldata, menudata, indexdata, moduledata, intlistdata,
+		templistdata, tunlistdata, boollistdata, gboollistdata,
+		gtunlistdata))
+
 	try:
 		os.chdir(working_dir)
 	except:
 		error("Could not chdir to target directory")	
 
 
-#arg, i have to go through this dom tree ahead of time to build up the menus
-	module_list = {}
-	for node in doc.getElementsByTagName("module"):
-		mod_name = mod_layer = interface_buf = ''
-
-		mod_name = node.getAttribute("name")
-		mod_layer = node.parentNode.getAttribute("name")
+	manifest = read_doc_manifest(DOC_MANIFEST)
+	page_hashes = {}
 
-		for desc in node.getElementsByTagName("summary"):
-			if desc.parentNode == node and desc:
-				mod_summary = format_html_desc(desc)
-		if not mod_layer in module_list:
-			module_list[mod_layer] = {}
+	index = index_records(records)
 
-		module_list[mod_layer][mod_name] = mod_summary
+	#build up the menus, and the summary of each module
+	module_list = {}
+	for mod_layer, modules in index.modules.items():
+		module_list[mod_layer] = {}
+		for node in modules:
+			if node.summary is not None:
+				mod_summary = node.summary
+			module_list[mod_layer][node.name] = mod_summary
 
 #generate index pages
-	main_content_buf = ''
+	layer_args = []
+	layer_content = {}
 	for mod_layer,modules in module_list.items():
 		menu = gen_doc_menu(mod_layer, module_list)
 
-		layer_summary = None
-		for desc in doc.getElementsByTagName("summary"):
-			if desc.parentNode.getAttribute("name") == mod_layer:
-				layer_summary = format_html_desc(desc)
+		layer_summary = index.summaries.get(mod_layer)
 
 		menu_args = { "menulist" : menu,
 			      "mod_layer" : mod_layer,
 			      "layer_summary" : layer_summary }
+		layer_args.append(menu_args)
+
+		index_file = mod_layer + ".html"
+		if not page_outdated(index_file, (doc_version, menu_args),
+				     manifest, page_hashes):
+			continue
+
+		# pyplate leaves its loop variables in the arguments
+		menu_args = dict(menu_args)
 		menu_tpl = pyplate.Template(menudata)
 		menu_buf = menu_tpl.execute_string(menu_args)
 
 		content_tpl = pyplate.Template(indexdata)
 		content_buf = content_tpl.execute_string(menu_args)
 
-		main_content_buf += content_buf
+		layer_content[mod_layer] = content_buf
 
 		body_args = { "menu" : menu_buf,
 			      "content" : content_buf }
 	
-		index_file = mod_layer + ".html"
 		index_fh = open(index_file, "w")
 		body_tpl = pyplate.Template(bodydata)
 		body_tpl.execute(index_fh, body_args)
 		index_fh.close()	
 
 	menu = gen_doc_menu(None, module_list)
-	menu_args = { "menulist" : menu,
-		      "mod_layer" : None }
-	menu_tpl = pyplate.Template(menudata)
-	menu_buf = menu_tpl.execute_string(menu_args)
+	index_file = "index.html"
+	if page_outdated(index_file, (doc_version, menu, layer_args),
+			 manifest, page_hashes):
+		main_content_buf = ''
+		for menu_args in layer_args:
+			if menu_args["mod_layer"] not in layer_content:
+				menu_args = dict(menu_args)
+				menu_tpl = pyplate.Template(menudata)
+				menu_tpl.execute_string(menu_args)
+				content_tpl = pyplate.Template(indexdata)
+				layer_content[menu_args["mod_layer"]] = \
+					content_tpl.execute_string(menu_args)
+			main_content_buf += layer_content[menu_args["mod_layer"]]
 
-	body_args = { "menu" : menu_buf,
-		      "content" : main_content_buf }
+		menu_args = { "menulist" : menu,
+			      "mod_layer" : None }
+		menu_tpl = pyplate.Template(menudata)
+		menu_buf = menu_tpl.execute_string(menu_args)
 
-	index_file = "index.html"
-	index_fh = open(index_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-	body_tpl.execute(index_fh, body_args)
-	index_fh.close()
+		body_args = { "menu" : menu_buf,
+			      "content" : main_content_buf }
+
+		index_fh = open(index_file, "w")
+		body_tpl = pyplate.Template(bodydata)
+		body_tpl.execute(index_fh, body_args)
+		index_fh.close()
 #now generate the individual module pages
 
+	pages = []
 	all_interfaces = []
 	all_templates = []
 	all_tunables = []
 	all_booleans = []
-	for node in doc.getElementsByTagName("module"):
-		mod_name = mod_layer = mod_desc = interface_buf = ''
-
-		mod_name = node.getAttribute("name")
-		mod_layer = node.parentNode.getAttribute("name")
+	for node in [mod for mods in index.modules.values() for mod in mods]:
+		mod_layer = node.layer
+		mod_name = node.name
+		mod_desc = node.desc
+		mod_summary = module_list[mod_layer][mod_name]
+		key = (mod_layer, mod_name)
 
 		mod_req = None
-		for req in node.getElementsByTagName("required"):
-			if req.getAttribute("val") == "true":
-				mod_req = True
-
-		for desc in node.getElementsByTagName("summary"):
-			if desc.parentNode == node:
-				mod_summary = format_html_desc(desc)
-		for desc in node.getElementsByTagName("desc"):
-			if desc.parentNode == node:
-				mod_desc = format_html_desc(desc)
+		if node.required:
+			mod_req = True
 
 		interfaces = []
-		for interface in node.getElementsByTagName("interface"):
+		for interface in index.interfaces.get(key, ()):
 			interface_parameters = []
-			interface_desc = interface_summary = None
-			interface_name = interface.getAttribute("name")
-			interface_line = interface.getAttribute("lineno")
-			for desc in interface.childNodes:
-				if desc.nodeName == "desc":
-					interface_desc = format_html_desc(desc)
-				elif desc.nodeName == "summary":
-					interface_summary = format_html_desc(desc)
-
-			for args in interface.getElementsByTagName("param"):
-				for desc in args.getElementsByTagName("summary"):
-					paramdesc = format_html_desc(desc)
-				paramname = args.getAttribute("name")
-				if args.getAttribute("optional") == "true":
+			for args in interface.params:
+				if args.desc is not None:
+					paramdesc = args.desc
+				if args.optional:
 					paramopt = "Yes"
 				else:
 					paramopt = "No"
-				if args.getAttribute("unused") == "true":
+				if args.unused:
 					paramunused = "Yes"
 				else:
 					paramunused = "No"
-				parameter = { "name" : paramname,
+				parameter = { "name" : args.name,
 					      "desc" : paramdesc,
 					      "optional" : paramopt,
 					      "unused" : paramunused }
 				interface_parameters.append(parameter)
-			interfaces.append( { "interface_name" : interface_name,
-					   "interface_summary" : interface_summary,
-					   "interface_desc" : interface_desc,
+			interfaces.append( { "interface_name" : interface.name,
+					   "interface_summary" : interface.summary,
+					   "interface_desc" : interface.desc,
 					   "interface_parameters" : interface_parameters })
 			#all_interfaces is for the main interface index with all interfaces
-			all_interfaces.append( { "interface_name" : interface_name,
-					   "interface_summary" : interface_summary,
-					   "interface_desc" : interface_desc,
+			all_interfaces.append( { "interface_name" : interface.name,
+					   "interface_summary" : interface.summary,
+					   "interface_desc" : interface.desc,
 					   "interface_parameters" : interface_parameters,
 					   "mod_name": mod_name,
 					   "mod_layer" : mod_layer })
 		interfaces.sort(key=int_cmp_func)	
-		interface_tpl = pyplate.Template(intdata)
-		interface_buf = interface_tpl.execute_string({"interfaces" : interfaces})
-	
 
-# now generate individual template pages
 		templates = []
-		for template in node.getElementsByTagName("template"):
+		for template in index.templates.get(key, ()):
 			template_parameters = []
-			template_desc = template_summary = None
-			template_name = template.getAttribute("name")
-			template_line = template.getAttribute("lineno")
-			for desc in template.childNodes:
-				if desc.nodeName == "desc":
-					template_desc = format_html_desc(desc)
-				elif desc.nodeName == "summary":
-					template_summary = format_html_desc(desc)
-
-			for args in template.getElementsByTagName("param"):
-				for desc in args.getElementsByTagName("summary"):
-					paramdesc = format_html_desc(desc)
-				paramname = args.getAttribute("name")
-				if args.getAttribute("optional") == "true":
+			for args in template.params:
+				if args.desc is not None:
+					paramdesc = args.desc
+				if args.optional:
 					paramopt = "Yes"
 				else:
 					paramopt = "No"
-				if args.getAttribute("unused") == "true":
+				if args.unused:
 					paramunused = "Yes"
 				else:
 					paramunused = "No"
-				parameter = { "name" : paramname,
+				parameter = { "name" : args.name,
 					      "desc" : paramdesc,
 					      "optional" : paramopt,
 					      "unused": paramunused }
 				template_parameters.append(parameter)
-			templates.append( { "template_name" : template_name,
-					   "template_summary" : template_summary,
-					   "template_desc" : template_desc,
+			templates.append( { "template_name" : template.name,
+					   "template_summary" : template.summary,
+					   "template_desc" : template.desc,
 					   "template_parameters" : template_parameters })
 			#all_templates is for the main interface index with all templates
-			all_templates.append( { "template_name" : template_name,
-					   "template_summary" : template_summary,
-					   "template_desc" : template_desc,
+			all_templates.append( { "template_name" : template.name,
+					   "template_summary" : template.summary,
+					   "template_desc" : template.desc,
 					   "template_parameters" : template_parameters,
 					   "mod_name": mod_name,
 					   "mod_layer" : mod_layer })
-
 		templates.sort(key=temp_cmp_func)	
-		template_tpl = pyplate.Template(templatedata)
-		template_buf = template_tpl.execute_string({"templates" : templates})
 
-		#generate 'boolean' pages
 		booleans = []
-		for boolean in node.getElementsByTagName("bool"):
-			boolean_parameters = []
-			boolean_desc = None
-			boolean_name = boolean.getAttribute("name")
-			boolean_dftval = boolean.getAttribute("dftval")
-			for desc in boolean.childNodes:
-				if desc.nodeName == "desc":
-					boolean_desc = format_html_desc(desc)
-
-			booleans.append({ "bool_name" : boolean_name,
-					  "desc" : boolean_desc,
-					  "def_val" : boolean_dftval })
+		for boolean in index.booleans.get(key, ()):
+			booleans.append({ "bool_name" : boolean.name,
+					  "desc" : boolean.desc,
+					  "def_val" : boolean.dftval })
 			#all_booleans is for the main boolean index with all booleans
-			all_booleans.append({ "bool_name" : boolean_name,
-					   "desc" : boolean_desc,
-					   "def_val" : boolean_dftval,
+			all_booleans.append({ "bool_name" : boolean.name,
+					   "desc" : boolean.desc,
+					   "def_val" : boolean.dftval,
 					   "mod_name": mod_name,
 					   "mod_layer" : mod_layer })
 		booleans.sort(key=bool_cmp_func)
-		boolean_tpl = pyplate.Template(booldata)
-		boolean_buf = boolean_tpl.execute_string({"booleans" : booleans})
 
-		#generate 'tunable' pages
 		tunables = []
-		for tunable in node.getElementsByTagName("tunable"):
-			tunable_parameters = []
-			tunable_desc = None
-			tunable_name = tunable.getAttribute("name")
-			tunable_dftval = tunable.getAttribute("dftval")
-			for desc in tunable.childNodes:
-				if desc.nodeName == "desc":
-					tunable_desc = format_html_desc(desc)
-
-			tunables.append({ "tun_name" : tunable_name,
-					  "desc" : tunable_desc,
-					  "def_val" : tunable_dftval })
+		for tunable in index.tunables.get(key, ()):
+			tunables.append({ "tun_name" : tunable.name,
+					  "desc" : tunable.desc,
+					  "def_val" : tunable.dftval })
 			#all_tunables is for the main tunable index with all tunables
-			all_tunables.append({ "tun_name" : tunable_name,
-					   "desc" : tunable_desc,
-					   "def_val" : tunable_dftval,
+			all_tunables.append({ "tun_name" : tunable.name,
+					   "desc" : tunable.desc,
+					   "def_val" : tunable.dftval,
 					   "mod_name": mod_name,
 					   "mod_layer" : mod_layer })
 		tunables.sort(key=tun_cmp_func)
-		tunable_tpl = pyplate.Template(tundata)
-		tunable_buf = tunable_tpl.execute_string({"tunables" : tunables})
-	
 
-		menu = gen_doc_menu(mod_layer, module_list)
+		page = { "mod_layer" : mod_layer,
+			       "mod_name" : mod_name,
+			       "mod_summary" : mod_summary,
+			       "mod_desc" : mod_desc,
+			       "mod_req" : mod_req,
+			       "interfaces" : interfaces,
+			       "templates" : templates,
+			       "tunables" : tunables,
+			       "booleans" : booleans,
+			       "menu" : gen_doc_menu(mod_layer, module_list) }
+		module_file = mod_layer + "_" + mod_name + ".html"
+		if page_outdated(module_file, (doc_version, page), manifest,
+				 page_hashes):
+			pages.append(page)
+
+	# the module pages are independent of each other, and of the index
+	# pages below, so with more than one job they are rendered in worker
+	# processes while the indexes are built here.
+	page_templates = { "interface" : intdata,
+			   "template" : templatedata,
+			   "tunable" : tundata,
+			   "boolean" : booldata,
+			   "menu" : menudata,
+			   "module" : moduledata,
+			   "body" : bodydata }
+	pool = None
+	try:
+		if jobs > 1 and len(pages) > 1:
+			pool = get_pool(jobs)
+			chunksize = max(1, len(pages) // (jobs * 4))
+			written = pool.map(functools.partial(write_module_page,
+				page_templates), pages, chunksize=chunksize)
+		else:
+			for page in pages:
+				write_module_page(page_templates, page)
 
-		menu_tpl = pyplate.Template(menudata)
-		menu_buf = menu_tpl.execute_string({ "menulist" : menu })
-
-
-		# pyplate's execute_string gives us a line of whitespace in
-		# template_buf or interface_buf if there are no interfaces or
-		# templates for this module. This is problematic because the
-		# HTML templates use a conditional if on interface_buf or
-		# template_buf being 'None' to decide if the "Template:" or
-		# "Interface:" headers need to be printed in the module pages.
-		# This detects if either of these are just whitespace, and sets
-		# their values to 'None' so that when applying it to the
-		# templates, they are properly recognized as not existing.
-		if not interface_buf.strip():
-			interface_buf = None
-		if not template_buf.strip():
-			template_buf = None
-		if not tunable_buf.strip():
-			tunable_buf = None
-		if not boolean_buf.strip():
-			boolean_buf = None
-
-		module_args = { "mod_layer" : mod_layer,
-			      "mod_name" : mod_name,	
-			      "mod_summary" : mod_summary,
-			      "mod_desc" : mod_desc,
-			      "mod_req" : mod_req,
-			      "interfaces" : interface_buf,
-			      "templates" : template_buf,
-			      "tunables" : tunable_buf,
-			      "booleans" : boolean_buf }
-
-		module_tpl = pyplate.Template(moduledata)
-		module_buf = module_tpl.execute_string(module_args)
 
-		body_args = { "menu" : menu_buf,
-			      "content" : module_buf }
-			  
-		module_file = mod_layer + "_" + mod_name + ".html"
-		module_fh = open(module_file, "w")
-		body_tpl = pyplate.Template(bodydata)
-		body_tpl.execute(module_fh, body_args)
-		module_fh.close()
+		menu = gen_doc_menu(None, module_list)
+		menu_args = { "menulist" : menu,
+			      "mod_layer" : None }
+		menu_tpl = pyplate.Template(menudata)
+		menu_buf = menu_tpl.execute_string(menu_args)
 
-		
-	menu = gen_doc_menu(None, module_list)
-	menu_args = { "menulist" : menu,
-		      "mod_layer" : None }
-	menu_tpl = pyplate.Template(menudata)
-	menu_buf = menu_tpl.execute_string(menu_args)
-	
-	#build the interface index
-	all_interfaces.sort(key=int_cmp_func)
-	interface_tpl = pyplate.Template(intlistdata)
-	interface_buf = interface_tpl.execute_string({"interfaces" : all_interfaces})
-	int_file = "interfaces.html"
-	int_fh = open(int_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf, 
-		      "content" : interface_buf }
-
-	body_tpl.execute(int_fh, body_args)
-	int_fh.close()
-
-
-	#build the template index
-	all_templates.sort(key=temp_cmp_func)
-	template_tpl = pyplate.Template(templistdata)
-	template_buf = template_tpl.execute_string({"templates" : all_templates})
-	temp_file = "templates.html"
-	temp_fh = open(temp_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf, 
-		      "content" : template_buf }
-
-	body_tpl.execute(temp_fh, body_args)
-	temp_fh.close()
-
-
-	#build the global tunable index
-	global_tun = []
-	for tunable in doc.getElementsByTagName("tunable"):
-		if tunable.parentNode.nodeName == "policy":
-			tunable_name = tunable.getAttribute("name")
-			default_value = tunable.getAttribute("dftval")
-			for desc in tunable.getElementsByTagName("desc"):
-				description = format_html_desc(desc)
-			global_tun.append( { "tun_name" : tunable_name,
-						"def_val" : default_value,
+		#build the interface index
+		all_interfaces.sort(key=int_cmp_func)
+		int_file = "interfaces.html"
+		if page_outdated(int_file, (doc_version, menu, all_interfaces),
+				 manifest, page_hashes):
+			interface_tpl = pyplate.Template(intlistdata)
+			interface_buf = interface_tpl.execute_string({"interfaces" : all_interfaces})
+			int_fh = open(int_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf, 
+				      "content" : interface_buf }
+
+			body_tpl.execute(int_fh, body_args)
+			int_fh.close()
+
+
+		#build the template index
+		all_templates.sort(key=temp_cmp_func)
+		temp_file = "templates.html"
+		if page_outdated(temp_file, (doc_version, menu, all_templates),
+				 manifest, page_hashes):
+			template_tpl = pyplate.Template(templistdata)
+			template_buf = template_tpl.execute_string({"templates" : all_templates})
+			temp_fh = open(temp_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf, 
+				      "content" : template_buf }
+
+			body_tpl.execute(temp_fh, body_args)
+			temp_fh.close()
+
+
+		#build the global tunable index
+		global_tun = []
+		for tunable in index.global_tunables:
+			if tunable.desc is not None:
+				description = tunable.desc
+			global_tun.append( { "tun_name" : tunable.name,
+						"def_val" : tunable.dftval,
 						"desc" : description } )
-	global_tun.sort(key=tun_cmp_func)
-	global_tun_tpl = pyplate.Template(gtunlistdata)
-	global_tun_buf = global_tun_tpl.execute_string({"tunables" : global_tun})
-	global_tun_file = "global_tunables.html"
-	global_tun_fh = open(global_tun_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf,
-		      "content" : global_tun_buf }
-
-	body_tpl.execute(global_tun_fh, body_args)
-	global_tun_fh.close()
-
-	#build the tunable index
-	all_tunables = all_tunables + global_tun
-	all_tunables.sort(key=tun_cmp_func)
-	tunable_tpl = pyplate.Template(tunlistdata)
-	tunable_buf = tunable_tpl.execute_string({"tunables" : all_tunables})
-	temp_file = "tunables.html"
-	temp_fh = open(temp_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf, 
-		      "content" : tunable_buf }
-
-	body_tpl.execute(temp_fh, body_args)
-	temp_fh.close()
-
-	#build the global boolean index
-	global_bool = []
-	for boolean in doc.getElementsByTagName("bool"):
-		if boolean.parentNode.nodeName == "policy":
-			bool_name = boolean.getAttribute("name")
-			default_value = boolean.getAttribute("dftval")
-			for desc in boolean.getElementsByTagName("desc"):
-				description = format_html_desc(desc)
-			global_bool.append( { "bool_name" : bool_name,
-						"def_val" : default_value,
+		global_tun.sort(key=tun_cmp_func)
+		global_tun_file = "global_tunables.html"
+		if page_outdated(global_tun_file, (doc_version, menu, global_tun),
+				 manifest, page_hashes):
+			global_tun_tpl = pyplate.Template(gtunlistdata)
+			global_tun_buf = global_tun_tpl.execute_string({"tunables" : global_tun})
+			global_tun_fh = open(global_tun_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf,
+				      "content" : global_tun_buf }
+
+			body_tpl.execute(global_tun_fh, body_args)
+			global_tun_fh.close()
+
+		#build the tunable index
+		all_tunables = all_tunables + global_tun
+		all_tunables.sort(key=tun_cmp_func)
+		temp_file = "tunables.html"
+		if page_outdated(temp_file, (doc_version, menu, all_tunables),
+				 manifest, page_hashes):
+			tunable_tpl = pyplate.Template(tunlistdata)
+			tunable_buf = tunable_tpl.execute_string({"tunables" : all_tunables})
+			temp_fh = open(temp_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf, 
+				      "content" : tunable_buf }
+
+			body_tpl.execute(temp_fh, body_args)
+			temp_fh.close()
+
+		#build the global boolean index
+		global_bool = []
+		for boolean in index.global_booleans:
+			if boolean.desc is not None:
+				description = boolean.desc
+			global_bool.append( { "bool_name" : boolean.name,
+						"def_val" : boolean.dftval,
 						"desc" : description } )
-	global_bool.sort(key=bool_cmp_func)
-	global_bool_tpl = pyplate.Template(gboollistdata)
-	global_bool_buf = global_bool_tpl.execute_string({"booleans" : global_bool})
-	global_bool_file = "global_booleans.html"
-	global_bool_fh = open(global_bool_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf,
-		      "content" : global_bool_buf }
-
-	body_tpl.execute(global_bool_fh, body_args)
-	global_bool_fh.close()
-	
-	#build the boolean index
-	all_booleans = all_booleans + global_bool
-	all_booleans.sort(key=bool_cmp_func)
-	boolean_tpl = pyplate.Template(boollistdata)
-	boolean_buf = boolean_tpl.execute_string({"booleans" : all_booleans})
-	temp_file = "booleans.html"
-	temp_fh = open(temp_file, "w")
-	body_tpl = pyplate.Template(bodydata)
-
-	body_args = { "menu" : menu_buf, 
-		      "content" : boolean_buf }
-
-	body_tpl.execute(temp_fh, body_args)
-	temp_fh.close()
-
-
+		global_bool.sort(key=bool_cmp_func)
+		global_bool_file = "global_booleans.html"
+		if page_outdated(global_bool_file, (doc_version, menu, global_bool),
+				 manifest, page_hashes):
+			global_bool_tpl = pyplate.Template(gboollistdata)
+			global_bool_buf = global_bool_tpl.execute_string({"booleans" : global_bool})
+			global_bool_fh = open(global_bool_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf,
+				      "content" : global_bool_buf }
+
+			body_tpl.execute(global_bool_fh, body_args)
+			global_bool_fh.close()
+
+		#build the boolean index
+		all_booleans = all_booleans + global_bool
+		all_booleans.sort(key=bool_cmp_func)
+		temp_file = "booleans.html"
+		if page_outdated(temp_file, (doc_version, menu, all_booleans),
+				 manifest, page_hashes):
+			boolean_tpl = pyplate.Template(boollistdata)
+			boolean_buf = boolean_tpl.execute_string({"booleans" : all_booleans})
+			temp_fh = open(temp_file, "w")
+			body_tpl = pyplate.Template(bodydata)
+
+			body_args = { "menu" : menu_buf, 
+				      "content" : boolean_buf }
+
+			body_tpl.execute(temp_fh, body_args)
+			temp_fh.close()
+
+		if pool:
+			# collect the results to raise the errors of the workers
+			list(written)
+	finally:
+		if pool:
+			pool.shutdown()
+
+	write_doc_manifest(DOC_MANIFEST, page_hashes)
 
 def error(error):
 	"""
@@ -779,11 +1070,12 @@ def usage():
 	sys.stdout.write("-d --docs <dir>		--	write interface documentation to <dir>\n")
 	sys.stdout.write("-x --xml <file>		--	filename to read xml data from\n")
 	sys.stdout.write("-T --templates <dir>		--	template directory for documents\n")
+	sys.stdout.write("-j --jobs <n>			--	render module pages in <n> parallel processes\n")
 
 
 # MAIN PROGRAM
 try:
-	opts, args = getopt.getopt(sys.argv[1:], "b:m:d:x:T:", ["booleans","modules","docs","xml", "templates"])
+	opts, args = getopt.getopt(sys.argv[1:], "b:m:d:x:T:j:", ["booleans","modules","docs","xml", "templates", "jobs="])
 except getopt.GetoptError:
 	usage()
 	sys.exit(1)
@@ -791,6 +1083,7 @@ except getopt.GetoptError:
 booleans = modules = docsdir = None
 templatedir = "templates/"
 xmlfile = "policy.xml"
+jobs = 1
 
 for opt, val in opts:
 	if opt in ("-b", "--booleans"):
@@ -803,18 +1096,24 @@ for opt, val in opts:
 		xmlfile = val
 	if opt in ("-T", "--templates"):
 		templatedir = val
+	if opt in ("-j", "--jobs"):
+		try:
+			jobs = int(val)
+		except ValueError:
+			usage()
+			sys.exit(1)
 
-doc = read_policy_xml(xmlfile)
+records = read_policy_xml(xmlfile)
 		
 if booleans:
-	namevalue_list = []
+	namevalues = {}
 	if os.path.exists(booleans):
 		try:
 			conf = open(booleans, 'r')
 		except:
 			error("Could not open booleans file for reading")
 
-		namevalue_list = get_conf(conf)
+		namevalues = get_conf(conf)
 
 		conf.close()
 
@@ -823,26 +1122,26 @@ if booleans:
 	except:
 		error("Could not open booleans file for writing")
 
-	gen_booleans_conf(doc, conf, namevalue_list)
+	gen_booleans_conf(records, conf, namevalues)
 	conf.close()
 
 
 if modules:
-	namevalue_list = []
+	namevalues = {}
 	if os.path.exists(modules):
 		try:
 			conf = open(modules, 'r')
 		except:
 			error("Could not open modules file for reading")
-		namevalue_list = get_conf(conf)	
+		namevalues = get_conf(conf)	
 		conf.close()
 
 	try:
 		conf = open(modules, 'w')
 	except:
 		error("Could not open modules file for writing")
-	gen_module_conf(doc, conf, namevalue_list)
+	gen_module_conf(records, conf, namevalues)
 	conf.close()
 
 if docsdir: 
-	gen_docs(doc, docsdir, templatedir)
+	gen_docs(records, docsdir, templatedir, jobs)
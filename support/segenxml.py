@@ -20,6 +20,17 @@ import os
 import glob
 import re
 import getopt
+import itertools
+import io
+import hashlib
+import locale
+import time
+import cProfile
+import pickle
+import json
+import multiprocessing
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
 
 # GLOBALS
 
@@ -33,43 +44,67 @@ bool_files = []
 xml_tunable_files = []
 xml_bool_files = []
 output_dir = ""
+cache_dir = ""
+record_calls = False
+stats_count = 0
+module_stats = []
+preread = {}
 
 # Pre compiled regular expressions:
 
-# Matches either an interface or a template declaration. Will give the tuple:
-#	("interface" or "template", name)
+# Matches an interface, template, gen_bool or gen_tunable declaration. Lines
+#  are classified once: this is only tried on lines starting with white
+#  space or the first letter of a declaration. Will give the named groups:
+#	interface: "interface" or "template", name: the interface name, or
+#	boolean: "tunable" or "bool", bool_name: the name,
+#	 dftval: "true" or "false"
 # Some examples:
 #	"interface(`kernel_read_system_state',`"
-#	 -> ("interface", "kernel_read_system_state")
+#	 -> interface="interface", name="kernel_read_system_state"
 #	"template(`base_user_template',`"
-#	 -> ("template", "base_user_template")
-INTERFACE = re.compile("^\s*(interface|template)\(`(\w*)'")
-
-# Matches either a gen_bool or a gen_tunable statement. Will give the tuple:
-#	("tunable" or "bool", name, "true" or "false")
-# Some examples:
+#	 -> interface="template", name="base_user_template"
 #	"gen_bool(secure_mode, false)"
-#	 -> ("bool", "secure_mode", "false")
+#	 -> boolean="bool", bool_name="secure_mode", dftval="false"
 #	"gen_tunable(allow_kerberos, false)"
-#	 -> ("tunable", "allow_kerberos", "false")
-BOOLEAN = re.compile("^\s*gen_(tunable|bool)\(\s*(\w*)\s*,\s*(true|false)\s*\)")
-
-# Matches a XML comment in the policy, which is defined as any line starting
-#  with two # and at least one character of white space. Will give the single
-#  valued tuple:
-#	("comment")
-# Some Examples:
+#	 -> boolean="tunable", bool_name="allow_kerberos", dftval="false"
+DECLARATION = re.compile(r"\s*(?:"
+	r"(?P<interface>interface|template)\(`(?P<name>\w*)'|"
+	r"gen_(?P<boolean>tunable|bool)\(\s*(?P<bool_name>\w*)\s*,\s*(?P<dftval>true|false)\s*\))")
+
+# XML comments in the policy are lines starting with two # and at least one
+#  character of white space. They are recognized by their first characters,
+#  without a regular expression, and give the text without the leading and
+#  trailing white space. Some examples:
 #	"## <summary>"
-#	 -> ("<summary>")
+#	 -> "<summary>"
 #	"##		The domain allowed access.	"
-#	 -> ("The domain allowed access.")
-XML_COMMENT = re.compile("^##\s+(.*?)\s*$")
+#	 -> "The domain allowed access."
+
+# Matches the names of the macros called on a line of an interface or
+#  template body. Only names that are interfaces or templates themselves are
+#  used in the cross reference index. Some examples:
+#	"	kernel_read_system_state($1)"
+#	 -> ["kernel_read_system_state"]
+#	"	allow $1 proc_t:dir list_dir_perms;"
+#	 -> []
+CALL = re.compile(r"\b(\w+)\(")
+
+# Matches a comment in an interface or template body, up to the end of the
+#  line.
+COMMENT = re.compile("#.*")
 
 
 # FUNCTIONS
-def getModuleXML(file_name):
+def getModule(file_name):
 	'''
-	Returns the XML data for a module in a list, one line per list item.
+	Returns the model of a module, a dict with its name and file name, the
+	lines of its own XML documentation, its interfaces and templates, and
+	its bools and tunables, in the order they are declared, and the XML
+	comments not attributed to anything. If
+	record_calls is set, the names of the macros called by each
+	interface/template body are recorded too. Returns None if the
+	module cannot be read. The module files are read lazily line by
+	line.
 	'''
 
 	# Gather information.
@@ -80,182 +115,667 @@ def getModuleXML(file_name):
 
 	# Try to open the file, if it cant, just ignore it.
 	try:
-		module_file = open(module_if, "r")
-		module_code = module_file.readlines()
-		module_file.close()
+		module_file = openSource(module_if)
 	except:
 		warning("cannot open file %s for read, skipping" % file_name)
-		return []
-
-	module_buf = []
+		return None
 
 	# Infer the module name, which is the base of the file name.
-	module_buf.append("<module name=\"%s\" filename=\"%s\">\n" 
-		% (os.path.splitext(os.path.split(file_name)[-1])[0], module_if))
+	module = {
+		"name": os.path.splitext(os.path.split(file_name)[-1])[0],
+		"filename": module_if,
+		"doc": [],
+		"interfaces": [],
+		"booleans": [],
+		"orphans": [],
+	}
 
 	temp_buf = []
 	interface = None
+	body = None
+	bodies = []
 
 	# finding_header is a flag to denote whether we are still looking
 	#  for the XML documentation at the head of the file.
 	finding_header = True
 
-	# Get rid of whitespace at top of file
-	while(module_code and module_code[0].isspace()):
-		module_code = module_code[1:]
-
-	# Go line by line and figure out what to do with it.
+	# Go line by line and figure out what to do with it. Whitespace at
+	#  the top of the file is skipped, and not counted in the line
+	#  numbers.
 	line_num = 0
-	for line in module_code:
-		line_num += 1
-		if finding_header:
-			# If there is a XML comment, add it to the temp buffer.
-			comment = XML_COMMENT.match(line)
-			if comment:
-				temp_buf.append(comment.group(1) + "\n")
-				continue
-
-			# Once a line that is not an XML comment is reached,
-			#  either put the XML out to module buffer as the
-			#  module's documentation, or attribute it to an
-			#  interface/template.
-			elif temp_buf:
-				finding_header = False
-				interface = INTERFACE.match(line)
-				if not interface:
-					module_buf += temp_buf
-					temp_buf = []
+	with module_file:
+		for line in itertools.dropwhile(str.isspace, module_file):
+			line_num += 1
+
+			# Classify the line once by its first character, only
+			#  lines starting with white space or the first letter
+			#  of interface/template can declare one.
+			comment = None
+			declaration = None
+			first = line[0]
+			if first == "#":
+				if line[1:2] == "#" and line[2:3].isspace():
+					comment = line[2:].strip()
+			elif first in "it" or first.isspace():
+				declaration = DECLARATION.match(line)
+				if declaration and not declaration.group("interface"):
+					declaration = None
+
+			if finding_header:
+				# If there is a XML comment, add it to the temp buffer.
+				if comment is not None:
+					temp_buf.append(comment + "\n")
 					continue
 
-		# Skip over empty lines
-		if line.isspace():
-			continue
+				# Once a line that is not an XML comment is reached,
+				#  either put the XML out as the module's
+				#  documentation, or attribute it to an
+				#  interface/template.
+				elif temp_buf:
+					finding_header = False
+					interface = declaration
+					if not interface:
+						module["doc"] += temp_buf
+						temp_buf = []
+						continue
+
+			# Skip over empty lines
+			if line.isspace():
+				continue
 
-		# Grab a comment and add it to the temprorary buffer, if it
-		#  is there.
-		comment = XML_COMMENT.match(line)
-		if comment:
-			temp_buf.append(comment.group(1) + "\n")
-			continue
+			# Grab a comment and add it to the temprorary buffer, if it
+			#  is there.
+			if comment is not None:
+				temp_buf.append(comment + "\n")
+				continue
 
-		# Grab the interface information. This is only not true when
-		#  the interface is at the top of the file and there is no
-		#  documentation for the module.
-		if not interface:
-			interface = INTERFACE.match(line)
-		if interface:
-			# Add the opening tag for the interface/template
-			groups = interface.groups()
-			module_buf.append("<%s name=\"%s\" lineno=\"%s\">\n" % (groups[0], groups[1], line_num))
-
-			# Add all the comments attributed to this interface to
-			#  the module buffer.
-			if temp_buf:
-				module_buf += temp_buf
-				temp_buf = []
+			# Grab the interface information. This is only not true when
+			#  the interface is at the top of the file and there is no
+			#  documentation for the module.
+			if not interface:
+				interface = declaration
+			if interface:
+				groups = interface.group("interface", "name")
+
+				# Add default summaries and parameters so that the
+				#  DTD is happy.
+				if not temp_buf:
+					warning ("unable to find XML for %s %s()" % (groups[0], groups[1]))
+					temp_buf = ["<summary>\n",
+						"Summary is missing!\n",
+						"</summary>\n",
+						"<param name=\"?\">\n",
+						"<summary>\n",
+						"Parameter descriptions are missing!\n",
+						"</summary>\n",
+						"</param>\n"]
+
+				# All the comments are attributed to this
+				#  interface/template.
+				module["interfaces"].append({
+					"type": groups[0],
+					"name": groups[1],
+					"lineno": line_num,
+					"doc": temp_buf,
+					"calls": [],
+				})
+				if record_calls:
+					body = []
+					bodies.append(body)
 
-			# Add default summaries and parameters so that the
-			#  DTD is happy.
-			else:
-				warning ("unable to find XML for %s %s()" % (groups[0], groups[1]))	
-				module_buf.append("<summary>\n")
-				module_buf.append("Summary is missing!\n")
-				module_buf.append("</summary>\n")
-				module_buf.append("<param name=\"?\">\n")
-				module_buf.append("<summary>\n")
-				module_buf.append("Parameter descriptions are missing!\n")
-				module_buf.append("</summary>\n")
-				module_buf.append("</param>\n")
-
-			# Close the interface/template tag.
-			module_buf.append("</%s>\n" % interface.group(1))
-
-			interface = None
-			continue
+				temp_buf = []
+				interface = None
+				continue
 
+			# Anything else is in the body of the last interface/template.
+			if body is not None:
+				body.append(line)
 
+	# Record what the interfaces/templates call.
+	for interface, body in zip(module["interfaces"], bodies):
+		body = COMMENT.sub("", "".join(body))
+		interface["calls"] = sorted(set(CALL.findall(body)))
 
-	# If the file just had a header, add the comments to the module buffer.
+	# If the file just had a header, add the comments to the module.
 	if finding_header:
-		module_buf += temp_buf
+		module["doc"] += temp_buf
 	# Otherwise there are some lingering XML comments at the bottom, warn
 	#  the user.
 	elif temp_buf:
 		warning("orphan XML comments at bottom of file %s" % file_name)
+		module["orphans"] += temp_buf
 
 	# Process the TE file if it exists.
-	module_buf = module_buf + getTunableXML(module_te, "both")
+	module["booleans"] = getBooleans(module_te, "both", module["orphans"])
 
-	module_buf.append("</module>\n")
+	return module
 
-	return module_buf
+def iterModuleXML(module):
+	'''
+	Yields the XML data for a module model, one line at a time.
+	'''
 
-def getTunableXML(file_name, kind):
+	yield "<module name=\"%s\" filename=\"%s\">\n" % (module["name"], module["filename"])
+	yield from module["doc"]
+
+	for interface in module["interfaces"]:
+		yield "<%s name=\"%s\" lineno=\"%s\">\n" \
+			% (interface["type"], interface["name"], interface["lineno"])
+		yield from interface["doc"]
+		yield "</%s>\n" % interface["type"]
+
+	yield from iterBooleansXML(module["booleans"])
+
+	yield "</module>\n"
+
+def openSource(file_name):
 	'''
-	Return all the XML for the tunables/bools in the file specified.
+	Opens a policy source file for reading. Files read in advance by
+	getModuleStats() are not read again.
+	'''
+
+	if file_name in preread:
+		return io.TextIOWrapper(io.BytesIO(preread.pop(file_name)))
+
+	return open(file_name, "r")
+
+def getModuleStats(file_name):
+	'''
+	Returns the model of a module like getModule(), and statistics about
+	it: the time spent reading and parsing its files, their size in bytes
+	and lines, and the number of interfaces, templates, bools/tunables and
+	orphan XML comments in it.
+	'''
+
+	stats = {"name": file_name, "bytes": 0, "lines": 0}
+
+	# Read the files up front, so reading and parsing are timed apart.
+	start = time.perf_counter()
+	for suffix in (".if", ".te"):
+		try:
+			source_file = open(file_name + suffix, "rb")
+			preread[file_name + suffix] = source_file.read()
+			source_file.close()
+		except (IOError, OSError):
+			continue
+		stats["bytes"] += len(preread[file_name + suffix])
+		stats["lines"] += preread[file_name + suffix].count(b"\n")
+	stats["read"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	module = getModule(file_name)
+	stats["parse"] = time.perf_counter() - start
+	preread.clear()
+
+	if module:
+		interfaces = [interface["type"] for interface in module["interfaces"]]
+		stats["interfaces"] = interfaces.count("interface")
+		stats["templates"] = interfaces.count("template")
+		stats["bools"] = len(module["booleans"])
+		stats["orphans"] = len(module["orphans"])
+	else:
+		stats.update(interfaces=0, templates=0, bools=0, orphans=0)
+
+	return (module, stats)
+
+def printStats(count):
+	'''
+	Writes the statistics of the slowest modules read, at most count of
+	them, and the totals over all modules to stderr.
+	'''
+
+	columns = ("read", "parse", "bytes", "lines", "interfaces", "templates", "bools", "orphans")
+	row = "%-40s %8s %8s %9s %7s %10s %9s %5s %7s\n"
+
+	sys.stderr.write(row % (("module", "read ms", "parse ms") + columns[2:]))
+	slowest = sorted(module_stats, key=lambda stats: stats["read"] + stats["parse"], reverse=True)
+	for stats in slowest[:count]:
+		sys.stderr.write(row % ((stats["name"], "%.2f" % (stats["read"] * 1000),
+			"%.2f" % (stats["parse"] * 1000)) + tuple(stats[column] for column in columns[2:])))
+
+	totals = [sum(stats[column] for stats in module_stats) for column in columns]
+	sys.stderr.write(row % (("total (%d modules)" % len(module_stats),
+		"%.2f" % (totals[0] * 1000), "%.2f" % (totals[1] * 1000)) + tuple(totals[2:])))
+
+def getModuleOutput(file_name):
+	'''
+	Returns the model of a module, the warnings written while reading it,
+	and its statistics from getModuleStats() if they were requested, or
+	None. This runs getModule() in the worker processes of iterModules().
+	'''
+
+	stderr = sys.stderr
+	sys.stderr = io.StringIO()
+	try:
+		if stats_count:
+			module, stats = getModuleStats(file_name)
+		else:
+			module = getModule(file_name)
+			stats = None
+		warnings = sys.stderr.getvalue()
+	finally:
+		sys.stderr = stderr
+
+	return (module, warnings, stats)
+
+def getScriptVersion():
+	'''
+	Returns a hash of this script, so cached XML is not used after the
+	script changes.
+	'''
+
+	script_file = open(os.path.abspath(__file__), "rb")
+	script_version = hashlib.sha1(script_file.read()).hexdigest()
+	script_file.close()
+
+	return script_version
+
+def getModuleCacheKey(file_name):
+	'''
+	Returns the cache key of a module, a hash of everything its model and
+	warnings depend on: this script, the options, the module name and
+	the contents of its .if and .te files.
+	'''
+
+	key = hashlib.sha1()
+	key.update(("%s\0%s\0%s\0%s\0%s\0" % (script_version, sys.argv[0], warn, record_calls, file_name)).encode())
+
+	for suffix in (".if", ".te"):
+		try:
+			module_file = open(file_name + suffix, "rb")
+			key.update(module_file.read())
+			module_file.close()
+		except (IOError, OSError):
+			key.update(b"\0missing")
+		key.update(b"\0")
+
+	return key.hexdigest()
+
+def getModuleCached(file_name):
+	'''
+	Returns the model of a module, the warnings and the statistics like
+	getModuleOutput().
+	If a cache directory was given, the result is looked up there by
+	getModuleCacheKey() first, and stored there if it is not found.
+	'''
+
+	if not cache_dir:
+		return getModuleOutput(file_name)
+
+	cache_file = os.path.join(cache_dir, getModuleCacheKey(file_name))
+
+	try:
+		cached = open(cache_file, "rb")
+		result = pickle.load(cached)
+		cached.close()
+		return result
+	except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+		pass
+
+	result = getModuleOutput(file_name)
+
+	# Write the cache entry atomically, parallel runs may share the cache.
+	try:
+		cached = open(cache_file + ".%d" % os.getpid(), "wb")
+		pickle.dump(result, cached, pickle.HIGHEST_PROTOCOL)
+		cached.close()
+		os.replace(cache_file + ".%d" % os.getpid(), cache_file)
+	except (IOError, OSError):
+		warning("cannot write cache file %s, skipping" % cache_file)
+
+	return result
+
+def getPool(jobs):
+	'''
+	Returns a pool of jobs worker processes.
+	'''
+
+	# Forked workers inherit the settings from the command line. Before
+	#  Python 3.7 the context cannot be chosen, the default is fork on
+	#  Unix.
+	if sys.version_info < (3, 7):
+		return concurrent.futures.ProcessPoolExecutor(jobs)
+	return concurrent.futures.ProcessPoolExecutor(jobs,
+		mp_context=multiprocessing.get_context("fork"))
+
+def iterModuleOutputs(module_names, jobs, pool=None):
+	'''
+	Yields the models of the modules, their warnings and statistics like
+	getModuleCached(), in the given order. With more than one job the
+	modules are read in a pool of worker processes, the one given or a
+	new one.
+	'''
+
+	if jobs <= 1 or len(module_names) <= 1:
+		yield from map(getModuleCached, module_names)
+		return
+
+	chunksize = max(1, len(module_names) // (jobs * 4))
+	if pool:
+		yield from pool.map(getModuleCached, module_names, chunksize=chunksize)
+		return
+
+	pool = getPool(jobs)
+	try:
+		yield from pool.map(getModuleCached, module_names, chunksize=chunksize)
+	finally:
+		pool.shutdown()
+
+def iterModules(module_names, jobs, pool=None):
+	'''
+	Yields the models of the modules, in the given order, and None for
+	modules that cannot be read. Their warnings are written in the
+	original order, so the output is the same with any number of jobs.
+	'''
+
+	if not cache_dir and not stats_count and (jobs <= 1 or len(module_names) <= 1):
+		for module_name in module_names:
+			yield getModule(module_name)
+		return
+
+	for module, warnings, stats in iterModuleOutputs(module_names, jobs, pool):
+		sys.stderr.write(warnings)
+		if stats:
+			module_stats.append(stats)
+		yield module
+
+def getModulesXML(module_names, jobs, read_modules=None):
+	'''
+	Writes the XML data for the modules, in the given order, to stdout.
+	If read_modules is a list, the models of the modules are added to it.
+	'''
+
+	for module in iterModules(module_names, jobs):
+		if module:
+			sys.stdout.writelines(iterModuleXML(module))
+			if read_modules is not None:
+				read_modules.append(module)
+
+def getFileStat(file_name):
+	'''
+	Returns the modification time and size of a file, or None if it does
+	not exist.
+	'''
+
+	try:
+		file_stat = os.stat(file_name)
+	except OSError:
+		return None
+
+	return [file_stat.st_mtime_ns, file_stat.st_size]
+
+def getFileHash(file_name):
+	'''
+	Returns a hash of the contents of a file.
+	'''
+
+	try:
+		hash_file = open(file_name, "rb")
+		file_hash = hashlib.sha1(hash_file.read()).hexdigest()
+		hash_file.close()
+	except (IOError, OSError):
+		return None
+
+	return file_hash
+
+def readManifest(manifest_file):
+	'''
+	Returns the manifest written by writeLayerXML(), or None if it cannot
+	be read.
+	'''
+
+	try:
+		manifest = open(manifest_file, "rb")
+		result = pickle.load(manifest)
+		manifest.close()
+	except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+		return None
+
+	return result
+
+def writeLayerXML(output_file, header_files, module_names, jobs):
+	'''
+	Writes the XML data for a layer to a file: the contents of the header
+	files followed by the XML data of the modules, in the given order.
+
+	The file is updated incrementally. A manifest next to it records, for
+	every header and module, the modification times and sizes of its
+	files, a hash of them, the warnings, and the offset and length of its
+	data in the file. Headers and modules whose files have the same times
+	and sizes, or the same hash, are copied from the old file; only the
+	others are read again.
+	'''
+
+	manifest_file = output_file + ".manifest"
+	settings = [script_version, sys.argv[0], warn, record_calls]
+
+	# The old data can only be used if the file is still the one the
+	#  manifest describes, written with the same settings.
+	old_entries = {}
+	manifest = readManifest(manifest_file)
+	if manifest and manifest["settings"] == settings \
+			and manifest["output"] == getFileStat(output_file):
+		for entry in manifest["entries"]:
+			old_entries[(entry["kind"], entry["name"])] = entry
+
+	entries = []
+	changed = []
+	for kind, name in [("header", header_file) for header_file in header_files] + \
+			[("module", module_name) for module_name in module_names]:
+		if kind == "header":
+			stat = [getFileStat(name)]
+		else:
+			stat = [getFileStat(name + ".if"), getFileStat(name + ".te")]
+
+		# Entries are copied, so a name given twice still reads the old
+		#  data at the old offset.
+		entry = old_entries.get((kind, name))
+		if entry and entry["stat"] == stat:
+			entries.append(dict(entry))
+			continue
+
+		if kind == "header":
+			entry_hash = getFileHash(name)
+		else:
+			entry_hash = getModuleCacheKey(name)
+
+		if entry and entry["hash"] == entry_hash:
+			entries.append(dict(entry, stat=stat))
+			continue
+
+		entry = {"kind": kind, "name": name, "stat": stat, "hash": entry_hash, "offset": None}
+		if kind == "module":
+			changed.append(name)
+		entries.append(entry)
+
+	encoding = locale.getpreferredencoding(False)
+	module_outputs = iterModuleOutputs(changed, jobs)
+
+	try:
+		if old_entries:
+			old_file = open(output_file, "rb")
+		new_file = open(output_file + ".%d" % os.getpid(), "wb")
+	except (IOError, OSError):
+		error("cannot write %s" % output_file)
+
+	offset = 0
+	for entry in entries:
+		if entry["offset"] is not None:
+			old_file.seek(entry["offset"])
+			data = old_file.read(entry["length"])
+		elif entry["kind"] == "header":
+			data = b"".join(getXMLFileContents(entry["name"], "rb"))
+			entry["warnings"] = ""
+		else:
+			module, entry["warnings"], stats = next(module_outputs)
+			if stats:
+				module_stats.append(stats)
+			if module:
+				data = "".join(iterModuleXML(module)).encode(encoding)
+			else:
+				data = b""
+
+		sys.stderr.write(entry["warnings"])
+		new_file.write(data)
+		entry["offset"] = offset
+		entry["length"] = len(data)
+		offset += len(data)
+
+	if old_entries:
+		old_file.close()
+	new_file.close()
+
+	try:
+		os.replace(output_file + ".%d" % os.getpid(), output_file)
+	except (IOError, OSError):
+		error("cannot write %s" % output_file)
+
+	# Write the manifest atomically too.
+	manifest = {"settings": settings, "output": getFileStat(output_file), "entries": entries}
+	try:
+		manifest_out = open(manifest_file + ".%d" % os.getpid(), "wb")
+		pickle.dump(manifest, manifest_out, pickle.HIGHEST_PROTOCOL)
+		manifest_out.close()
+		os.replace(manifest_file + ".%d" % os.getpid(), manifest_file)
+	except (IOError, OSError):
+		warning("cannot write manifest %s, skipping" % manifest_file)
+
+def getBooleans(file_name, kind, orphans=None):
+	'''
+	Returns the models of the tunables/bools in the file specified, a list
+	of dicts with their kind, name, default value and the lines of their
+	XML documentation. If orphans is a list, the XML comments not
+	attributed to anything are added to it.
 	'''
 
 	# Try to open the file, if it cant, just ignore it.
 	try:
-		tunable_file = open(file_name, "r")
-		tunable_code = tunable_file.readlines()
-		tunable_file.close()
+		tunable_file = openSource(file_name)
 	except:
 		warning("cannot open file %s for read, skipping" % file_name)
 		return []
 
-	tunable_buf = []
+	booleans = []
 	temp_buf = []
 
 	# Find tunables and booleans line by line and use the comments above
 	# them.
-	for line in tunable_code:
-		# If it is an XML comment, add it to the buffer and go on.
-		comment = XML_COMMENT.match(line)
-		if comment:
-			temp_buf.append(comment.group(1) + "\n")
-			continue
-
-		# Get the boolean/tunable data.
-		boolean = BOOLEAN.match(line)
-
-		# If we reach a boolean/tunable declaration, attribute all XML
-		#  in the temp buffer to it and add XML to the tunable buffer.
-		if boolean:
-			# If there is a gen_bool in a tunable file or a
-			# gen_tunable in a boolean file, error and exit.
-			# Skip if both kinds are valid.
-			if kind != "both":
-				if boolean.group(1) != kind:
-					error("%s in a %s file." % (boolean.group(1), kind))
+	with tunable_file:
+		for line in tunable_file:
+			# If it is an XML comment, add it to the buffer and go on.
+			first = line[0]
+			if first == "#":
+				if line[1:2] == "#" and line[2:3].isspace():
+					temp_buf.append(line[2:].strip() + "\n")
+				continue
 
-			tunable_buf.append("<%s name=\"%s\" dftval=\"%s\">\n" % boolean.groups())
-			tunable_buf += temp_buf
-			temp_buf = []
-			tunable_buf.append("</%s>\n" % boolean.group(1))
+			# Get the boolean/tunable data, only lines starting with
+			#  white space or gen_ can declare one.
+			if first != "g" and not first.isspace():
+				continue
+			boolean = DECLARATION.match(line)
+
+			# If we reach a boolean/tunable declaration, attribute all XML
+			#  in the temp buffer to it.
+			if boolean and boolean.group("boolean"):
+				# If there is a gen_bool in a tunable file or a
+				# gen_tunable in a boolean file, error and exit.
+				# Skip if both kinds are valid.
+				if kind != "both":
+					if boolean.group("boolean") != kind:
+						error("%s in a %s file." % (boolean.group("boolean"), kind))
+
+				booleans.append({
+					"type": boolean.group("boolean"),
+					"name": boolean.group("bool_name"),
+					"dftval": boolean.group("dftval"),
+					"doc": temp_buf,
+				})
+				temp_buf = []
 
 	# If there are XML comments at the end of the file, they arn't
 	# attributed to anything. These are ignored.
 	if len(temp_buf):
 		warning("orphan XML comments at bottom of file %s" % file_name)
+		if orphans is not None:
+			orphans += temp_buf
 
+	return booleans
+
+def iterBooleansXML(booleans):
+	'''
+	Yields the XML data for a list of tunable/bool models, one line at a
+	time.
+	'''
+
+	for boolean in booleans:
+		yield "<%s name=\"%s\" dftval=\"%s\">\n" \
+			% (boolean["type"], boolean["name"], boolean["dftval"])
+		yield from boolean["doc"]
+		yield "</%s>\n" % boolean["type"]
+
+def writeTunableXML(file_name, tunable_buf):
+	'''
+	Writes the XML for the tunables/bools in the file specified to a file
+	of the same name in output_dir. It is written in one write and renamed
+	into place, so it is never seen half written.
+	'''
+
+	xmlfile = os.path.split(file_name)[1] + ".xml"
+	xml_path = os.path.join(output_dir, xmlfile)
+
+	try:
+		xml_outfile = open(xml_path + ".%d" % os.getpid(), "w")
+		xml_outfile.write("".join(tunable_buf))
+		xml_outfile.close()
+		os.replace(xml_path + ".%d" % os.getpid(), xml_path)
+	except (IOError, OSError):
+		warning ("cannot write to file %s, skipping creation" % xmlfile)
+
+def getTunableXML(file_name, kind):
+	'''
+	Return all the XML for the tunables/bools in the file specified.
+	'''
+
+	tunable_buf = list(iterBooleansXML(getBooleans(file_name, kind)))
 
 	# If the caller requested a the global_tunables and global_booleans to be
 	# output to a file output them now
 	if len(output_dir) > 0:
-		xmlfile = os.path.split(file_name)[1] + ".xml"
-
-		try:
-			xml_outfile = open(output_dir + "/" + xmlfile, "w")
-			for tunable_line in tunable_buf:
-				xml_outfile.write (tunable_line)
-			xml_outfile.close()
-		except:
-			warning ("cannot write to file %s, skipping creation" % xmlfile)
+		writeTunableXML(file_name, tunable_buf)
 
 	return tunable_buf
 
-def getXMLFileContents (file_name):
+def getGlobalOutput(kind, file_name):
+	'''
+	Returns the models of the tunables/bools in a global tunable or bool
+	file, or the lines of a global XML tunable or bool file if kind is
+	"xml", the warnings written while reading it, and the exit status
+	if it had an error, or 0. Tunable and bool files are written to
+	output_dir like getTunableXML() does. This runs in the worker
+	processes of getPolicy().
+	'''
+
+	stderr = sys.stderr
+	sys.stderr = io.StringIO()
+	status = 0
+	try:
+		if kind == "xml":
+			result = getXMLFileContents(file_name)
+		else:
+			result = getBooleans(file_name, kind)
+			if len(output_dir) > 0:
+				writeTunableXML(file_name, iterBooleansXML(result))
+	except SystemExit as e:
+		result = []
+		status = e.code
+	finally:
+		warnings = sys.stderr.getvalue()
+		sys.stderr = stderr
+
+	return (result, warnings, status)
+
+def getXMLFileContents (file_name, mode="r"):
 	'''
 	Return all the XML in the file specified.
 	'''
@@ -264,7 +784,7 @@ def getXMLFileContents (file_name):
 	# Try to open the xml file for this type of file
 	# append the contents to the buffer.
 	try:
-		tunable_xml = open(file_name, "r")
+		tunable_xml = open(file_name, mode)
 		tunable_buf += tunable_xml.readlines()
 		tunable_xml.close()
 	except:
@@ -272,53 +792,291 @@ def getXMLFileContents (file_name):
 
 	return tunable_buf
 
-def getPolicyXML():
+def getModuleList(file_name):
+	'''
+	Returns the modules listed in a module list file, one module per line.
+	Empty lines and lines starting with # are ignored.
+	'''
+
+	try:
+		list_file = open(file_name, "r")
+		list_lines = list_file.readlines()
+		list_file.close()
+	except:
+		error("cannot open module list file %s for read" % file_name)
+
+	module_list = []
+	for line in list_lines:
+		line = line.strip()
+		if line and not line.startswith("#"):
+			module_list.append(line)
+
+	return module_list
+
+def getLayer(layer_name, layer_dir):
 	'''
-	Return the compelete reference policy XML documentation through a list,
-	one line per item.
+	Returns the model of a layer without its modules, a dict with its name
+	and the lines of its metadata XML, and the names of its modules, all
+	the .te files in the layer directory.
 	'''
 
-	policy_buf = []
-	policy_buf.append("<policy>\n")
+	layer = {
+		"name": layer_name,
+		"doc": getXMLFileContents(os.path.join(layer_dir, meta + ".xml")),
+		"modules": [],
+	}
 
-	# Add to the XML each layer specified by the user.
-	for layer in layers.keys ():
-		policy_buf += getLayerXML(layer, layers[layer])
+	# Sort the file names like make does, "a-b.te" comes before "a.te".
+	module_names = [os.path.splitext(te_file)[0]
+		for te_file in sorted(glob.glob(os.path.join(layer_dir, "*.te")))]
 
-	# Add to the XML each tunable file specified by the user.
-	for tunable_file in tunable_files:
-		policy_buf += getTunableXML(tunable_file, "tunable")
+	return (layer, module_names)
 
-	# Add to the XML each XML tunable file specified by the user.
-	for tunable_file in xml_tunable_files:
-		policy_buf += getXMLFileContents (tunable_file)
+def getPolicy(jobs):
+	'''
+	Returns the model of the complete reference policy, a dict with the
+	layers specified by the user and their modules, the global tunables
+	and bools, and the lines of the global XML tunable and bool files.
+	The modules of all layers are read by iterModules(). With more than
+	one job, the global files are read in the same pool of worker
+	processes, concurrently with the modules.
+	'''
+
+	policy = {"layers": [], "tunables": [], "tunables_xml": [],
+		"booleans": [], "booleans_xml": []}
+
+	layer_modules = []
+	for layer_name in layers.keys ():
+		layer, module_names = getLayer(layer_name, layers[layer_name])
+		policy["layers"].append(layer)
+		layer_modules.append(module_names)
+
+	# The global files specified by the user, and where they go.
+	global_files = [("tunable", tunable_file, "tunables") for tunable_file in tunable_files] + \
+		[("xml", tunable_file, "tunables_xml") for tunable_file in xml_tunable_files] + \
+		[("bool", bool_file, "booleans") for bool_file in bool_files] + \
+		[("xml", bool_file, "booleans_xml") for bool_file in xml_bool_files]
+
+	pool = None
+	if jobs > 1:
+		pool = getPool(jobs)
+		global_outputs = [pool.submit(getGlobalOutput, kind, file_name)
+			for kind, file_name, part in global_files]
+
+	try:
+		modules = iterModules(list(itertools.chain.from_iterable(layer_modules)), jobs, pool)
+		for layer, module_names in zip(policy["layers"], layer_modules):
+			for module in itertools.islice(modules, len(module_names)):
+				if module:
+					layer["modules"].append(module)
+
+		for i, (kind, file_name, part) in enumerate(global_files):
+			if pool:
+				result, warnings, status = global_outputs[i].result()
+			else:
+				result, warnings, status = getGlobalOutput(kind, file_name)
+			sys.stderr.write(warnings)
+			if status:
+				sys.exit(status)
+			policy[part] += result
+	finally:
+		if pool:
+			pool.shutdown()
+
+	return policy
+
+def getPolicyXML(policy):
+	'''
+	Yields the compelete reference policy XML documentation for a policy
+	model, one line at a time.
+	'''
+
+	yield "<?xml version=\"1.0\" encoding=\"ISO-8859-1\" standalone=\"no\"?>\n"
+	yield "<!DOCTYPE policy SYSTEM \"policy.dtd\">\n"
+	yield "<policy>\n"
+
+	for layer in policy["layers"]:
+		yield "<layer name=\"%s\">\n" % layer["name"]
+		yield from layer["doc"]
+		for module in layer["modules"]:
+			yield from iterModuleXML(module)
+		yield "</layer>\n"
+
+	yield from iterBooleansXML(policy["tunables"])
+	yield from policy["tunables_xml"]
+	yield from iterBooleansXML(policy["booleans"])
+	yield from policy["booleans_xml"]
 
-	# Add to the XML each bool file specified by the user.
-	for bool_file in bool_files:
-		policy_buf += getTunableXML(bool_file, "bool")
+	yield "</policy>\n"
 
-	# Add to the XML each XML bool file specified by the user.
-	for bool_file in xml_bool_files:
-		policy_buf += getXMLFileContents (bool_file)
+def getDocText(element, tag):
+	'''
+	Returns the text of the first child element with the tag, with the
+	whitespace collapsed, or an empty string.
+	'''
+
+	child = element.find(tag)
+	if child is None:
+		return ""
+
+	return " ".join("".join(child.itertext()).split())
+
+def describeNode(node, description):
+	'''
+	Adds the summary and parameters in the XML documentation of a model
+	node to it, so users of a model dump do not need to parse the XML.
+	'''
 
-	policy_buf.append("</policy>\n")
+	try:
+		doc = ElementTree.fromstring("<doc>" + "".join(node["doc"]) + "</doc>")
+	except ElementTree.ParseError as e:
+		warning("cannot parse XML of %s: %s" % (description, e))
+		doc = ElementTree.Element("doc")
+
+	node["summary"] = getDocText(doc, "summary")
+
+	if "lineno" in node:
+		node["params"] = [{
+			"name": param.get("name", ""),
+			"optional": param.get("optional") == "true",
+			"unused": param.get("unused") == "true",
+			"summary": getDocText(param, "summary"),
+		} for param in doc.findall("param")]
+	elif "dftval" in node:
+		node["desc"] = getDocText(doc, "desc")
+
+def writePolicyDump(policy, file_name):
+	'''
+	Writes a policy model to a file with writeData(), with the summaries
+	and parameters added to its nodes.
+	'''
+
+	for layer in policy["layers"]:
+		describeNode(layer, "layer %s" % layer["name"])
+		for module in layer["modules"]:
+			describeNode(module, "module %s" % module["name"])
+			for interface in module["interfaces"]:
+				describeNode(interface, "%s %s()" % (interface["type"], interface["name"]))
+			for boolean in module["booleans"]:
+				describeNode(boolean, "%s %s" % (boolean["type"], boolean["name"]))
+	for boolean in policy["tunables"] + policy["booleans"]:
+		describeNode(boolean, "%s %s" % (boolean["type"], boolean["name"]))
 
-	return policy_buf
+	writeData(policy, file_name)
+
+def getXref(modules):
+	'''
+	Returns the cross reference index of the interfaces and templates of
+	the modules, a dict of three dicts keyed by interface/template name:
+	"modules" gives the module declaring it, "callers" the interfaces and
+	templates calling it, and "depends" all the interfaces and templates
+	depending on it, directly or through other ones.
+	'''
+
+	declared = {}
+	for module in modules:
+		for interface in module["interfaces"]:
+			declared[interface["name"]] = module["name"]
+
+	callers = dict((name, set()) for name in declared)
+	for module in modules:
+		for interface in module["interfaces"]:
+			for callee in interface["calls"]:
+				if callee in callers and callee != interface["name"]:
+					callers[callee].add(interface["name"])
+
+	# Walk up the callers of every interface, this also terminates on
+	#  recursive calls.
+	depends = {}
+	for name in declared:
+		found = set()
+		todo = [name]
+		while todo:
+			for caller in callers[todo.pop()]:
+				if caller not in found:
+					found.add(caller)
+					todo.append(caller)
+		found.discard(name)
+		depends[name] = sorted(found)
+
+	return {
+		"modules": declared,
+		"callers": dict((name, sorted(callers[name])) for name in declared),
+		"depends": depends,
+	}
+
+def writeData(data, file_name):
+	'''
+	Writes a model or index to a file, as JSON if the file name ends in
+	.json, and pickled otherwise.
+	'''
+
+	try:
+		if file_name.endswith(".json"):
+			data_file = open(file_name, "w")
+			json.dump(data, data_file, indent=1)
+		else:
+			data_file = open(file_name, "wb")
+			pickle.dump(data, data_file, pickle.HIGHEST_PROTOCOL)
+		data_file.close()
+	except (IOError, OSError):
+		error("cannot write %s" % file_name)
+
+def readData(file_name):
+	'''
+	Reads a model or index written by writeData().
+	'''
+
+	try:
+		if file_name.endswith(".json"):
+			data_file = open(file_name, "r")
+			data = json.load(data_file)
+		else:
+			data_file = open(file_name, "rb")
+			data = pickle.load(data_file)
+		data_file.close()
+	except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+		error("cannot read %s" % file_name)
+
+	return data
 
 def usage():
 	"""
 	Displays a message describing the proper usage of this script.
 	"""
 
-	sys.stdout.write("usage: %s [-w] [-mtb] <file>\n\n" % sys.argv[0])
+	sys.stdout.write("usage: %s [-w] [-mlLtb] <file>\n\n" % sys.argv[0])
 	sys.stdout.write("-w --warn\t\t\tshow warnings\n"+\
-	"-m --module <file>\t\tname of module to process\n"+\
+	"-m --module <file>\t\tname of module to process, may be repeated\n"+\
+	"-l --module-list <file>\t\tname of file listing modules to process\n"+\
+	"-j --jobs <n>\t\t\tprocess modules in <n> parallel processes\n"+\
+	"-c --cache <dir>\t\tcache module XML in <dir>\n"+\
+	"-p --policy\t\t\twrite the complete policy XML, of the -L layers and\n"+\
+	"\t\t\t\tthe -t, -b, -T and -B global files\n"+\
+	"-L --layer <dir>\t\tlayer to put in the complete policy XML, may be repeated\n"+\
+	"-T --xml-tunable <file>\t\tglobal tunable XML file to put in the policy XML\n"+\
+	"-B --xml-boolean <file>\t\tglobal boolean XML file to put in the policy XML\n"+\
+	"-o --output-dir <dir>\t\talso write the XML of the -t and -b files to <dir>\n"+\
+	"-u --update <file>\t\twrite the module XML to <file>, updating it incrementally\n"+\
+	"-H --header <file>\t\twith -u, put the contents of <file> first, may be repeated\n"+\
+	"-s --stats <n>\t\t\tshow statistics of the <n> slowest modules,\n"+\
+	"\t\t\t\tnot using the cache\n"+\
+	"-P --profile <file>\t\twrite cProfile data to <file> (of the main process only)\n"+\
+	"-d --dump <file>\t\tdump the policy model to <file> (JSON if named *.json),\n"+\
+	"\t\t\t\twith -p or -L\n"+\
+	"-x --xref <file>\t\twrite the interface cross reference index to <file>,\n"+\
+	"\t\t\t\tor read it with -q (JSON if named *.json), not with -u\n"+\
+	"-q --query <name>\t\tlist the interfaces depending on interface <name>\n"+\
 	"-t --tunable <file>\t\tname of global tunable file to process\n"+\
 	"-b --boolean <file>\t\tname of global boolean file to process\n\n")
 
 	sys.stdout.write("examples:\n")
 	sys.stdout.write("> %s -w -m policy/modules/apache\n" % sys.argv[0])
+	sys.stdout.write("> %s -w -m policy/modules/apache -m policy/modules/cron\n" % sys.argv[0])
 	sys.stdout.write("> %s -t policy/global_tunables\n" % sys.argv[0])
+	sys.stdout.write("> %s -x xref.json -q kernel_read_system_state\n" % sys.argv[0])
+	sys.stdout.write("> %s -L policy/modules/kernel -L policy/modules/system -t policy/global_tunables -b policy/global_booleans -d policy.json\n" % sys.argv[0])
+	sys.stdout.write("> %s -p -j 4 -o doc -t policy/global_tunables -b policy/global_booleans -L policy/modules/kernel\n" % sys.argv[0])
 
 def warning(description):
 	'''
@@ -345,7 +1103,15 @@ def error(description):
 
 # Defaults
 warn = False
-module = False
+modules = []
+jobs = 1
+update_file = ""
+profile_file = ""
+whole_policy = False
+header_files = []
+dump_file = ""
+xref_file = ""
+query = ""
 tunable = False
 boolean = False
 
@@ -356,7 +1122,7 @@ if len(sys.argv) <= 1:
 
 # Parse command line args
 try:
-	opts, args = getopt.getopt(sys.argv[1:], 'whm:t:b:', ['warn', 'help', 'module=', 'tunable=', 'boolean='])
+	opts, args = getopt.getopt(sys.argv[1:], 'whm:l:j:c:pL:T:B:o:u:H:s:P:d:x:q:t:b:', ['warn', 'help', 'module=', 'module-list=', 'jobs=', 'cache=', 'policy', 'layer=', 'xml-tunable=', 'xml-boolean=', 'output-dir=', 'update=', 'header=', 'stats=', 'profile=', 'dump=', 'xref=', 'query=', 'tunable=', 'boolean='])
 except getopt.GetoptError:
 	usage()
 	sys.exit(2)
@@ -367,20 +1133,115 @@ for o, a in opts:
 		usage()
 		sys.exit(0)
 	elif o in ('-m', '--module'):
-		module = a
-		break
+		modules.append(a)
+	elif o in ('-l', '--module-list'):
+		modules += getModuleList(a)
+	elif o in ('-j', '--jobs'):
+		try:
+			jobs = int(a)
+		except ValueError:
+			usage()
+			sys.exit(2)
+	elif o in ('-c', '--cache'):
+		cache_dir = a
+	elif o in ('-p', '--policy'):
+		whole_policy = True
+	elif o in ('-L', '--layer'):
+		layers[os.path.basename(os.path.normpath(a))] = a
+	elif o in ('-T', '--xml-tunable'):
+		xml_tunable_files.append(a)
+	elif o in ('-B', '--xml-boolean'):
+		xml_bool_files.append(a)
+	elif o in ('-o', '--output-dir'):
+		output_dir = a
+	elif o in ('-u', '--update'):
+		update_file = a
+	elif o in ('-H', '--header'):
+		header_files.append(a)
+	elif o in ('-s', '--stats'):
+		try:
+			stats_count = int(a)
+		except ValueError:
+			usage()
+			sys.exit(2)
+	elif o in ('-P', '--profile'):
+		profile_file = a
+	elif o in ('-d', '--dump'):
+		dump_file = a
+		record_calls = True
+	elif o in ('-x', '--xref'):
+		xref_file = a
+		record_calls = True
+	elif o in ('-q', '--query'):
+		query = a
 	elif o in ('-t', '--tunable'):
 		tunable = a
-		break
+		tunable_files.append(a)
 	elif o in ('-b', '--boolean'):
 		boolean = a
-		break
+		bool_files.append(a)
 	else:
 		usage()
 		sys.exit(2)
 
-if module:
-	sys.stdout.writelines(getModuleXML(module))
+# The incremental update does not keep the calls of the interfaces, so it
+#  cannot write or query the cross reference index.
+if update_file and (xref_file or query):
+	usage()
+	sys.exit(2)
+
+# Only the complete policy has a model to dump.
+if dump_file and not (whole_policy or layers):
+	usage()
+	sys.exit(2)
+
+# The statistics are about reading the modules, not the cache.
+if stats_count:
+	cache_dir = ""
+
+if cache_dir or update_file:
+	script_version = getScriptVersion()
+if cache_dir:
+	# Parallel make runs may create the directory at the same time
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+	except OSError:
+		warning("cannot create cache directory %s, not caching" % cache_dir)
+		cache_dir = ""
+
+if profile_file:
+	profiler = cProfile.Profile()
+	profiler.enable()
+
+if query:
+	if not xref_file:
+		usage()
+		sys.exit(2)
+	xref = readData(xref_file)
+	if query not in xref["depends"]:
+		error("%s is not an interface or template in %s" % (query, xref_file))
+	for name in xref["depends"][query]:
+		sys.stdout.write("%s\n" % name)
+elif whole_policy or layers:
+	policy = getPolicy(jobs)
+	sys.stdout.writelines(getPolicyXML(policy))
+	if xref_file:
+		writeData(getXref([module for layer in policy["layers"] for module in layer["modules"]]), xref_file)
+	if dump_file:
+		writePolicyDump(policy, dump_file)
+elif update_file:
+	# Any remaining arguments after the modules are further modules, so
+	#  "-m mod1 mod2 mod3" processes all of them.
+	modules += args
+	writeLayerXML(update_file, header_files, modules, jobs)
+elif modules:
+	modules += args
+	if xref_file:
+		read_modules = []
+		getModulesXML(modules, jobs, read_modules)
+		writeData(getXref(read_modules), xref_file)
+	else:
+		getModulesXML(modules, jobs)
 elif tunable:
 	sys.stdout.writelines(getTunableXML(tunable, "tunable"))
 elif boolean:
@@ -389,3 +1250,13 @@ else:
 	usage()
 	sys.exit(2)
 
+if profile_file:
+	profiler.disable()
+	try:
+		profiler.dump_stats(profile_file)
+	except (IOError, OSError):
+		error("cannot write profile %s" % profile_file)
+
+if stats_count:
+	printStats(stats_count)
+